@@ -3,6 +3,7 @@
 Copyright (c) 2019 InnoGames GmbH
 """
 
+import json
 from distutils.util import strtobool
 from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network
 from itertools import chain
@@ -10,17 +11,28 @@ from types import GeneratorType
 
 from adminapi.datatype import validate_value, json_to_datatype
 from adminapi.filters import Any, BaseFilter, ContainedOnlyBy
-from adminapi.request import send_request, json_encode_extra
+from adminapi.request import send_request, stream_request, json_encode_extra
 from adminapi.exceptions import DatasetError
 
 NEW_OBJECT_ENDPOINT = '/dataset/new_object'
 COMMIT_ENDPOINT = '/dataset/commit'
 QUERY_ENDPOINT = '/dataset/query'
 CREATE_ENDPOINT = '/dataset/create'
+STREAM_HEADER = '{"status": "success", "result": ['
+STREAM_FOOTER = ']}'
+STREAM_ERROR = '!'
 
 
 class BaseQuery(object):
-    def __init__(self, filters=None, restrict=['hostname'], order_by=None):
+    def __init__(
+        self, filters=None, restrict=['hostname'], order_by=None,
+        limit=None, offset=0, after=None,
+    ):
+        self._limit = limit
+        self._offset = offset
+        self._after = after
+        self._total_count = None
+        self._next_after = None
         if filters is None:
             self._filters = None
             self._restrict = None
@@ -54,6 +66,12 @@ class BaseQuery(object):
             args.append('restrict=' + repr(self._restrict))
         if self._order_by is not None:
             args.append('order_by=' + repr(self._order_by))
+        if self._limit is not None:
+            args.append('limit=' + repr(self._limit))
+        if self._offset:
+            args.append('offset=' + repr(self._offset))
+        if self._after is not None:
+            args.append('after=' + repr(self._after))
         return 'Query({})'.format(', '.join(args))
 
     @property
@@ -95,9 +113,76 @@ class BaseQuery(object):
     def _fetch_results(self):
         raise NotImplementedError()
 
+    def _fetch_total_count(self):
+        raise NotImplementedError()
+
+    def _stream_results(self):
+        raise NotImplementedError()
+
     def _fetch_new_object(self, servertype):
         raise NotImplementedError()
 
+    def count(self):
+        """Count all of the matching objects ignoring the limit and offset
+
+        It is cheaper than getting the length of the query, when a limit
+        or an offset is set, because the objects that are not going to be
+        returned don't need to be fetched.
+        """
+        if self._filters is None or (
+            self._limit is None and not self._offset and self._after is None
+        ):
+            return len(self)
+        if self._total_count is None:
+            self._total_count = self._fetch_total_count()
+        return self._total_count
+
+    def stream(self):
+        """Iterate the matching objects as they arrive
+
+        Unlike iterating the query itself, the objects are not kept on
+        the query, so the whole result doesn't need to be held in memory.
+        It also means that they cannot be committed through the query.
+        The caller can start working on the first objects, before the rest
+        of them is received.
+        """
+        if self._filters is None:
+            return iter(())
+        if self._limit is not None or self._offset or self._after is not None:
+            raise DatasetError('Cannot stream with limit, offset or after')
+        return self._stream_results()
+
+    def iter_pages(self, page_size):
+        """Iterate through the result with a new query for every page
+
+        The pages are fetched one by one only when they are needed, so
+        the whole result doesn't need to be held in memory.  Every page
+        continues right after the last object of the previous one.  The pages
+        are queries on their own, so they can be modified and committed
+        separately.  This is only supported with the default ordering.
+        """
+        if self._order_by is not None:
+            raise DatasetError('Cannot iterate pages with order_by')
+        return self._iter_pages(page_size)
+
+    def _iter_pages(self, page_size):
+        after = self._after
+        while True:
+            page = type(self)(
+                self._filters,
+                self._restrict,
+                self._order_by,
+                limit=page_size,
+                after=after,
+            )
+            if not page:
+                break
+            yield page
+
+            after = page._next_after
+            if after is None:
+                break
+
     def new_object(self, servertype):
         obj = self._fetch_new_object(servertype)
         if self._filters:
@@ -251,16 +336,69 @@ class Query(BaseQuery):
             obj._confirm_changes()
 
     def _fetch_results(self):
+        request_data = self._get_request_data()
+        if self._limit is not None:
+            request_data['limit'] = self._limit
+        if self._offset:
+            request_data['offset'] = self._offset
+        if self._after is not None:
+            request_data['after'] = self._after
+
+        response = send_request(QUERY_ENDPOINT, post_params=request_data)
+        if response['status'] == 'error':
+            _handle_exception(response)
+        self._total_count = response.get('total_count')
+        self._next_after = response.get('after')
+        return [_format_obj(s) for s in response['result']]
+
+    def _stream_results(self):
+        request_data = self._get_request_data()
+        request_data['stream'] = True
+        lines = stream_request(QUERY_ENDPOINT, post_params=request_data)
+
+        # The server puts every object on its own line after the first
+        # one.  Anything else on the first line means that the response is
+        # not streamed.  It can be an error, or the server can be too old
+        # to stream.
+        first_line = next(lines, None)
+        if first_line is None:
+            raise DatasetError('Empty response')
+        if first_line.rstrip() != STREAM_HEADER:
+            response = json.loads(first_line + ''.join(lines))
+            if response['status'] == 'error':
+                _handle_exception(response)
+            for result in response['result']:
+                yield _format_obj(result)
+            return
+
+        # The errors after the header are sent on their own line starting
+        # with the marker which leaves the document invalid.
+        for line in lines:
+            line = line.rstrip()
+            if line == STREAM_FOOTER:
+                return
+            if line.startswith(STREAM_ERROR):
+                _handle_exception(json.loads(line[len(STREAM_ERROR):]))
+            yield _format_obj(json.loads(line.lstrip(',')))
+
+        raise DatasetError('Incomplete response')
+
+    def _get_request_data(self):
         request_data = {'filters': self._filters}
         if self._restrict is not None:
             request_data['restrict'] = self._restrict
         if self._order_by is not None:
             request_data['order_by'] = self._order_by
 
-        response = send_request(QUERY_ENDPOINT, post_params=request_data)
-        if response['status'] == 'error':
-            _handle_exception(response)
-        return [_format_obj(s) for s in response['result']]
+        return request_data
+
+    def _fetch_total_count(self):
+        # The server returns the total count together with the results,
+        # unless a cursor is given.
+        self._get_results()
+        if self._total_count is None and self._after is not None:
+            return type(self)(self._filters, [], limit=0).count()
+        return self._total_count
 
 
 class DatasetObject(dict):
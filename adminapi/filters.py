@@ -13,17 +13,10 @@ class BaseFilter(object):
     def __init__(self, value):
         if type(self) == BaseFilter and isinstance(value, bool):
             pass
-        elif isinstance(value, (int, float)):
+        elif isinstance(value, (int, float, str)):
             pass
         elif isinstance(value, tuple(s[0] for s in STR_BASED_DATATYPES)):
             pass
-        elif isinstance(value, str):
-            for char in '\'"':
-                if char in value:
-                    raise FilterValueError(
-                        '"{}" character is not allowed on filter values'
-                        .format(char)
-                    )
         else:
             raise FilterValueError(
                 'Filter value cannot be {}'.format(type(value).__name__)
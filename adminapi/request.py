@@ -7,9 +7,11 @@ import os
 from hashlib import sha1
 import hmac
 from ssl import SSLError
+from threading import Lock
 import time
 import json
 from base64 import b64encode
+from collections import OrderedDict
 from datetime import datetime, timezone
 
 from urllib.error import HTTPError, URLError
@@ -64,6 +66,15 @@ class Settings:
     timeout = 60
     tries = 3
     sleep_interval = 5
+    # Number of the last responses to keep to send conditional requests
+    etag_cache_size = 16
+
+
+# The last responses carrying an ETag by the URL and the body of the request
+_etag_cache = OrderedDict()
+# The lock is held only while using the cache, and not during the requests,
+# so that the threads can still send their requests at the same time.
+_etag_cache_lock = Lock()
 
 
 def calc_message(timestamp, data=None):
@@ -106,18 +117,65 @@ def calc_app_id(auth_token):
 
 
 def send_request(endpoint, get_params=None, post_params=None):
+    """Send the request and return the decoded response
+
+    If we got a response with an ETag to the same request before, we ask
+    the server to send it again only when it has changed.  Otherwise, we
+    return the last one.
+    """
+    request = _build_request(endpoint, get_params, post_params)
+    key = (request.full_url, request.data)
+    with _etag_cache_lock:
+        cached = _etag_cache.get(key)
+    if cached:
+        request.add_header('If-None-Match', cached[0])
+
+    response = _send_request(request)
+    if cached and response.getcode() == 304:
+        etag, content = cached
+    else:
+        content = response.read().decode()
+        etag = response.info().get('ETag')
+    if etag:
+        _cache_response(key, etag, content)
+
+    # We keep the content instead of the decoded response, so that
+    # the callers modifying it wouldn't affect each other.
+    return json.loads(content)
+
+
+def _cache_response(key, etag, content):
+    """Remember the response as the last used one"""
+    with _etag_cache_lock:
+        _etag_cache[key] = (etag, content)
+        _etag_cache.move_to_end(key)
+        while len(_etag_cache) > Settings.etag_cache_size:
+            _etag_cache.popitem(last=False)
+
+
+def stream_request(endpoint, get_params=None, post_params=None):
+    """Send the request and iterate the lines of the response
+
+    The lines are yielded as they arrive, so the caller can start working
+    on them before the whole response is received.
+    """
     request = _build_request(endpoint, get_params, post_params)
+    response = _send_request(request)
+    with response:
+        for line in response:
+            yield line.decode()
+
+
+def _send_request(request):
     for retry in reversed(range(Settings.tries)):
         response = _try_request(request, retry)
-        if response:
-            break
+        if response is not None:
+            return response
 
         # In case of an error, sleep before trying again
         time.sleep(Settings.sleep_interval)
-    else:
-        assert False    # Cannot happen
 
-    return json.loads(response.read().decode())
+    assert False    # Cannot happen
 
 
 def _build_request(endpoint, get_params, post_params):
@@ -185,6 +243,10 @@ def _try_request(request, retry=False):
     try:
         return urlopen(request, timeout=Settings.timeout)
     except HTTPError as error:
+        # The error is also a response.  The caller knows what to do with
+        # not modified responses to the conditional requests.
+        if error.code == 304:
+            return error
         if error.code >= 500:
             if retry:
                 return None
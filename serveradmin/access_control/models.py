@@ -4,11 +4,13 @@ Copyright (c) 2019 InnoGames GmbH
 """
 
 from django.db import models
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 
 from adminapi.parse import parse_query
 from serveradmin.apps.models import Application
-from serveradmin.serverdb.models import Attribute
+from serveradmin.serverdb.models import Attribute, invalidate_metadata
 
 
 class AccessControlGroup(models.Model):
@@ -50,6 +52,7 @@ class AccessControlGroup(models.Model):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._filters = None
+        self._permissible_attribute_ids = None
 
     def __str__(self):
         return self.name
@@ -66,15 +69,43 @@ class AccessControlGroup(models.Model):
         names of (normal attributes + special attributes) - self.attributes
         """
 
+        if self._permissible_attribute_ids is None:
+            self.compile(
+                {a.pk for a in self.attributes.all()},
+                Attribute.objects.values_list('pk', flat=True),
+            )
+        return self._permissible_attribute_ids
+
+    def compile(self, attribute_ids, all_attribute_ids):
+        """Freeze the attribute ids this ACL allows changing
+
+        The metadata cache compiles the ACLs with the attributes it has
+        already loaded, so that the commits don't need to query them.
+        """
+
         if self.is_whitelist is False:
             # Set of all attributes, excluding the blacklisted ones
-            return (
-                {a.pk for a in Attribute.objects.all()} |
-                set(Attribute.specials.keys())
-            ).difference(
-                {a.pk for a in self.attributes.all()}
-            )
+            permissible_attribute_ids = (
+                set(all_attribute_ids) | set(Attribute.specials.keys())
+            ).difference(attribute_ids)
+        else:
+            # Set of attributes that this ACL allows to be modified
+            # XXX: There is currently no option to whitelist special
+            # attributes
+            permissible_attribute_ids = attribute_ids
+
+        self._permissible_attribute_ids = frozenset(permissible_attribute_ids)
+
+
+@receiver([post_save, post_delete], sender=AccessControlGroup)
+@receiver(m2m_changed, sender=AccessControlGroup.members.through)
+@receiver(m2m_changed, sender=AccessControlGroup.applications.through)
+@receiver(m2m_changed, sender=AccessControlGroup.attributes.through)
+def invalidate_access_control_groups(sender, action=None, **kwargs):
+    """Bump the metadata version to let all processes reload the ACLs
 
-        # Set of attributes that this ACL allows to be modified
-        # XXX: There is currently no option to whitelist special attributes
-        return {a.pk for a in self.attributes.all()}
+    The ACLs are cached together with the metadata, because the blacklists
+    depend on the attributes.  See serveradmin.serverdb.metadata.
+    """
+    if action is None or action.startswith('post_'):
+        invalidate_metadata(sender, **kwargs)
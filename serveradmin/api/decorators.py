@@ -16,6 +16,7 @@ from django.core.exceptions import (
     ValidationError,
 )
 from django.http import HttpResponse
+from django.http.response import HttpResponseBase
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.crypto import constant_time_compare
 from django.utils import timezone, dateformat
@@ -90,6 +91,12 @@ def api_view(view):
                 (timezone.now() - now).total_seconds()
             ),
         ])))
+
+        # The views can prepare their responses themselves, e.g. to stream
+        # the content.
+        if isinstance(return_value, HttpResponseBase):
+            return return_value
+
         return HttpResponse(
             json.dumps(return_value, default=json_encode_extra),
             content_type='application/x-json',
@@ -3,6 +3,8 @@
 Copyright (c) 2019 InnoGames GmbH
 """
 
+import json
+from itertools import chain
 from operator import itemgetter
 
 from django.core.exceptions import (
@@ -12,14 +14,22 @@ from django.core.exceptions import (
 )
 from django.contrib.auth.decorators import login_required
 from django.contrib.admindocs.utils import trim_docstring, parse_docstring
+from django.http import HttpResponseNotModified, StreamingHttpResponse
 from django.template.response import TemplateResponse, HttpResponse
+from django.utils.http import parse_etags, quote_etag
 
+from adminapi.dataset import STREAM_ERROR, STREAM_FOOTER, STREAM_HEADER
 from adminapi.filters import FilterValueError, filter_from_obj
 from serveradmin.api import ApiError, AVAILABLE_API_FUNCTIONS
 from serveradmin.api.decorators import api_view
+from adminapi.request import json_encode_extra
 from serveradmin.api.utils import build_function_description
 from serveradmin.serverdb.query_committer import commit_query
-from serveradmin.serverdb.query_executer import execute_query
+from serveradmin.serverdb.query_executer import (
+    execute_query_page,
+    get_query_etag,
+    stream_query,
+)
 from serveradmin.serverdb.query_materializer import (
     get_default_attribute_values
 )
@@ -92,11 +102,42 @@ def dataset_query(request, app, data):
             restrict = data['restrict']
 
         order_by = data.get('order_by')
-
-        return {
+        pagination = _get_pagination(data)
+
+        if data.get('stream'):
+            if pagination:
+                raise SuspiciousOperation(
+                    'Streaming cannot be used together with pagination'
+                )
+            return _get_stream_response(filters, restrict, order_by)
+
+        # The clients polling the same query again and again can send us
+        # the ETag of the result they got the last time.  We can tell them
+        # that it is still up-to-date without executing the query.
+        etag = get_query_etag(filters, restrict, order_by, **pagination)
+        if _if_none_match(request, etag):
+            response = HttpResponseNotModified()
+            response['ETag'] = quote_etag(etag)
+            return response
+
+        page = execute_query_page(filters, restrict, order_by, **pagination)
+        result = {
             'status': 'success',
-            'result': execute_query(filters, restrict, order_by),
+            'result': page.objects,
         }
+
+        # The total count and the cursor are only useful to paginate.
+        # We don't bother the older versions of the adminapi with them.
+        if pagination:
+            result['total_count'] = page.total_count
+            result['after'] = page.after
+
+        response = HttpResponse(
+            json.dumps(result, default=json_encode_extra),
+            content_type='application/x-json',
+        )
+        response['ETag'] = quote_etag(etag)
+        return response
     except (FilterValueError, ValidationError) as error:
         return {
             'status': 'error',
@@ -105,6 +146,96 @@ def dataset_query(request, app, data):
         }
 
 
+def _get_pagination(data):
+    """Get the pagination arguments of the query which are set"""
+    pagination = {}
+    if data.get('limit') is not None:
+        if not isinstance(data['limit'], int) or data['limit'] < 0:
+            raise SuspiciousOperation('Limit must be a positive integer')
+        pagination['limit'] = data['limit']
+    if data.get('offset'):
+        if not isinstance(data['offset'], int) or data['offset'] < 0:
+            raise SuspiciousOperation('Offset must be a positive integer')
+        pagination['offset'] = data['offset']
+    if data.get('after') is not None:
+        if not isinstance(data['after'], str):
+            raise SuspiciousOperation('After must be a string')
+        pagination['after'] = data['after']
+
+    return pagination
+
+
+def _if_none_match(request, etag):
+    """Check whether the client already has the result with the ETag
+
+    The ETags are compared weakly as If-None-Match requires, so the ones
+    marked as weak match, too.  The asterisk matches any result.
+    """
+    header = request.META.get('HTTP_IF_NONE_MATCH', '').strip()
+    if not header:
+        return False
+    if header == '*':
+        return True
+    return etag in parse_etags(header)
+
+
+def _get_stream_response(filters, restrict, order_by):
+    """Start streaming the results of the query
+
+    The first batch is fetched before the response is started, so that
+    the errors on it are returned as usual.
+    """
+    batches = stream_query(filters, restrict, order_by)
+    first_batch = next(batches, None)
+    if first_batch is not None:
+        batches = chain([first_batch], batches)
+
+    return StreamingHttpResponse(
+        _stream_query_response(batches), content_type='application/x-json'
+    )
+
+
+def _stream_query_response(batches):
+    """Generate the JSON response line by line
+
+    It is a valid JSON document as a whole, but we put every object on its
+    own line, so that the clients can parse the objects as they arrive
+    without parsing the whole document.
+
+    The status of the response is already sent, when the later batches
+    fail.  We put the error on its own line starting with a marker instead
+    of the footer, so that the document cannot be taken as complete.
+    The unexpected errors are raised again afterwards to be logged.
+    """
+    yield STREAM_HEADER + '\n'
+    separator = ''
+    try:
+        for objects in batches:
+            lines = []
+            for obj in objects:
+                lines.append(
+                    separator + json.dumps(obj, default=json_encode_extra)
+                )
+                separator = ','
+            if lines:
+                yield '\n'.join(lines) + '\n'
+    except (FilterValueError, ValidationError) as error:
+        yield _stream_error_line('ValueError', error)
+        return
+    except Exception as error:
+        yield _stream_error_line(error.__class__.__name__, error)
+        raise
+    yield STREAM_FOOTER + '\n'
+
+
+def _stream_error_line(error_type, error):
+    return STREAM_ERROR + json.dumps({
+        'status': 'error',
+        'type': error_type,
+        'message': str(error),
+    }) + '\n'
+
+
 @api_view
 def dataset_new_object(request, app, data):
     try:
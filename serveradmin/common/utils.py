@@ -6,6 +6,8 @@ Copyright (c) 2019 InnoGames GmbH
 import re
 import os
 from base64 import b64encode
+from collections import OrderedDict
+from threading import Lock
 
 _hostname_re = re.compile(
     r'^(?=.{1,255}$)[0-9A-Za-z](?:(?:[0-9A-Za-z]|-){0,61}'
@@ -28,3 +30,38 @@ def random_alnum_string(length):
         random_str = b64encode(random_bytes, b'??').decode().replace('?', '')
         if len(random_str) >= length:
             return random_str[:length]
+
+
+class LRUCache(object):
+    """Dictionary like cache keeping only the recently used items
+
+    It is safe to be shared by the threads.  The items are kept in the order
+    they are used, so that we can drop the oldest ones when the cache grows
+    over the maximum size.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
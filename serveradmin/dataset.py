@@ -5,7 +5,11 @@ Copyright (c) 2019 InnoGames GmbH
 
 from adminapi.dataset import BaseQuery, DatasetObject
 from serveradmin.serverdb.query_committer import commit_query
-from serveradmin.serverdb.query_executer import execute_query
+from serveradmin.serverdb.query_executer import (
+    count_query,
+    execute_query_page,
+    stream_query,
+)
 from serveradmin.serverdb.query_materializer import (
     get_default_attribute_values
 )
@@ -22,4 +26,20 @@ class Query(BaseQuery):
         self._confirm_changes()
 
     def _fetch_results(self):
-        return execute_query(self._filters, self._restrict, self._order_by)
+        page = execute_query_page(
+            self._filters, self._restrict, self._order_by,
+            self._limit, self._offset, self._after,
+        )
+        self._total_count = page.total_count
+        self._next_after = page.after
+        return page.objects
+
+    def _fetch_total_count(self):
+        return count_query(self._filters)
+
+    def _stream_results(self):
+        for objects in stream_query(
+            self._filters, self._restrict, self._order_by
+        ):
+            for obj in objects:
+                yield obj
@@ -0,0 +1,160 @@
+"""Serveradmin - Filter Optimizer
+
+Copyright (c) 2019 InnoGames GmbH
+"""
+# The filters are sent to us exactly as the users wrote them.  They are
+# often generated by scripts, so it is common to get deeply nested logical
+# filters, the same conditions multiple times, or conditions which cannot
+# match anything.  The SQL generator translates the filters one by one, so
+# all of this would end up on the query making it bigger and harder for
+# the database to plan.  We rewrite the filters to their simplest
+# equivalent form before passing them to it.
+#
+# The empty All() and Any() filters are used as the constants True and
+# False.  The callers check them with destiny() anyway.
+
+from adminapi.filters import (
+    All,
+    Any,
+    BaseFilter,
+    Comparison,
+    Empty,
+    GreaterThanOrEquals,
+    LessThanOrEquals,
+    Not,
+    Regexp,
+    StartsWith,
+)
+
+
+def optimize_filter(attribute, filt):
+    """Get the simplest filter equivalent to the given one
+
+    The filter objects are not modified.  New ones are created where
+    anything is changed.
+    """
+    if isinstance(filt, Not):
+        return _optimize_not(attribute, filt)
+
+    logical_type = _get_logical_type(filt)
+    if logical_type is not None:
+        return _optimize_logical(attribute, logical_type, filt.values)
+
+    return filt
+
+
+def get_filter_cost(filt):
+    """Estimate how expensive and how unselective the filter is
+
+    The exact matches can use the indexes, and usually match only a few
+    servers.  The pattern matches and the negations need to check all
+    of them.  The lower numbers are better.
+    """
+    if type(filt) == BaseFilter:
+        return 0
+    if isinstance(filt, (Not, Empty)):
+        return 5
+
+    logical_type = _get_logical_type(filt)
+    if logical_type is not None:
+        costs = [get_filter_cost(v) for v in filt.values]
+        if logical_type is All:
+            return min(costs, default=0)
+        return max(costs, default=0)
+
+    if isinstance(filt, Regexp):
+        return 4
+    if isinstance(filt, (
+        Comparison,
+        GreaterThanOrEquals,
+        LessThanOrEquals,
+        StartsWith,
+    )):
+        return 2
+    return 3
+
+
+def _optimize_not(attribute, filt):
+    value = optimize_filter(attribute, filt.value)
+    if isinstance(value, Not):
+        return value.value
+
+    destiny = value.destiny()
+    if destiny is not None:
+        return _get_constant(not destiny)
+
+    return Not(value)
+
+
+def _optimize_logical(attribute, logical_type, values):
+    """Flatten, fold and deduplicate the values of a logical filter
+
+    The deprecated And() and Or() filters are replaced with All() and
+    Any() on the way, so that the SQL generator can merge the exact
+    values of them.
+    """
+    # A True value decides Any(), and a False value decides All().
+    decisive = logical_type is Any
+
+    result = []
+    seen = set()
+    for value in _flatten(attribute, logical_type, values):
+        destiny = value.destiny()
+        if destiny is not None:
+            if destiny is decisive:
+                return _get_constant(decisive)
+            continue
+
+        # The representations of the filters include all of their
+        # properties, so they are good enough to find the duplicates.
+        key = repr(value)
+        if key not in seen:
+            seen.add(key)
+            result.append(value)
+
+    if logical_type is All and _contradicts(attribute, result):
+        return _get_constant(False)
+    if len(result) == 1:
+        return result[0]
+
+    # The sort is stable, so the filters of the same cost keep the order
+    # they were given.  The exact values come together at the beginning.
+    result.sort(key=get_filter_cost)
+
+    return logical_type(*result)
+
+
+def _flatten(attribute, logical_type, values):
+    for value in values:
+        value = optimize_filter(attribute, value)
+        if _get_logical_type(value) is logical_type:
+            yield from value.values
+        else:
+            yield value
+
+
+def _contradicts(attribute, values):
+    """Check whether the values cannot be matched all together
+
+    A single valued attribute cannot be equal to different values at
+    the same time.  We only check this for the strings, because the other
+    types can have multiple representations of the same value.
+    """
+    if attribute.multi or attribute.type != 'string':
+        return False
+
+    return len({str(v.value) for v in values if type(v) == BaseFilter}) > 1
+
+
+def _get_logical_type(filt):
+    if isinstance(filt, All):
+        return All
+    if isinstance(filt, Any):
+        return Any
+    return None
+
+
+def _get_constant(value):
+    if value:
+        return All()
+    return Any()
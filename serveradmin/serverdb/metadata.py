@@ -0,0 +1,163 @@
+"""Serveradmin - Metadata Cache
+
+Copyright (c) 2019 InnoGames GmbH
+"""
+# The attributes, the servertypes and the relations between them are needed
+# by almost every query and commit, but they change very rarely.  We keep
+# them in memory for the whole lifetime of the process.  All processes share
+# a version number on the database which is bumped whenever any of them
+# changes the metadata (see invalidate_metadata() on the models).  It is
+# cheap to check, so we do it every time the metadata is requested, and
+# reload everything when it doesn't match.  Both the version and the
+# metadata are always read from the default database, even when the query
+# runs on a replica, so that we wouldn't keep an old snapshot with the new
+# version.
+#
+# The access control groups are kept in here, too.  Every commit checks
+# them for every object it touches, and the blacklists depend on all of
+# the attributes.  The version is bumped when they are changed as well.
+
+from threading import Lock
+
+from django.db import DEFAULT_DB_ALIAS, connection
+
+from serveradmin.access_control.models import AccessControlGroup
+from serveradmin.serverdb.models import (
+    Attribute,
+    Servertype,
+    ServertypeAttribute,
+)
+
+_metadata = None
+_metadata_lock = Lock()
+
+
+class Metadata(object):
+    """Snapshot of the attributes, servertypes and their relations
+
+    The model objects are linked to each other in here, so that accessing
+    the foreign keys of them wouldn't hit the database.  They are shared
+    by all the users of the snapshot, so they must not be modified.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.servertypes = {
+            s.pk: s for s in Servertype.objects.using(DEFAULT_DB_ALIAS)
+        }
+        self.attributes = {
+            a.pk: a for a in Attribute.objects.using(DEFAULT_DB_ALIAS)
+        }
+
+        # The special attributes are not on the database, but most of
+        # the callers need to look them up together with the others.
+        self.attribute_lookup = dict(self.attributes)
+        self.attribute_lookup.update(Attribute.specials)
+
+        for attribute in self.attributes.values():
+            if attribute.target_servertype_id:
+                attribute.target_servertype = (
+                    self.servertypes[attribute.target_servertype_id]
+                )
+            if attribute.reversed_attribute_id:
+                attribute.reversed_attribute = (
+                    self.attributes[attribute.reversed_attribute_id]
+                )
+
+        # We index the servertype attributes by both of their sides.
+        self.servertype_attributes = {s: {} for s in self.servertypes}
+        self.attribute_servertype_attributes = {a: [] for a in self.attributes}
+        self.related_attribute_count = 0
+        for sa in ServertypeAttribute.objects.using(DEFAULT_DB_ALIAS):
+            sa.servertype = self.servertypes[sa.servertype_id]
+            sa.attribute = self.attributes[sa.attribute_id]
+            if sa.related_via_attribute_id:
+                sa.related_via_attribute = (
+                    self.attributes[sa.related_via_attribute_id]
+                )
+                self.related_attribute_count += 1
+            if sa.consistent_via_attribute_id:
+                sa.consistent_via_attribute = (
+                    self.attributes[sa.consistent_via_attribute_id]
+                )
+
+            self.servertype_attributes[sa.servertype_id][sa.attribute_id] = sa
+            self.attribute_servertype_attributes[sa.attribute_id].append(sa)
+
+        self._load_access_control_groups()
+
+    def get_servertype(self, servertype_id):
+        try:
+            return self.servertypes[servertype_id]
+        except KeyError:
+            raise Servertype.DoesNotExist(
+                'No servertype "{}"'.format(servertype_id)
+            )
+
+    def get_servertype_attributes(self, attribute_ids):
+        """Get the servertype attributes of the given attributes"""
+        return [
+            sa
+            for attribute_id in attribute_ids
+            for sa in self.attribute_servertype_attributes.get(
+                attribute_id, []
+            )
+        ]
+
+    def _load_access_control_groups(self):
+        """Compile the ACLs and index them by their users and applications"""
+        acl_attribute_ids = {}
+        for acl_id, attribute_id in self._get_acl_relations(
+            AccessControlGroup.attributes, 'attribute_id'
+        ):
+            acl_attribute_ids.setdefault(acl_id, set()).add(attribute_id)
+        self.access_control_groups = {}
+        for acl in AccessControlGroup.objects.using(DEFAULT_DB_ALIAS):
+            acl.compile(acl_attribute_ids.get(acl.pk, set()), self.attributes)
+            self.access_control_groups[acl.pk] = acl
+        self.user_access_control_groups = {}
+        for acl_id, user_id in self._get_acl_relations(
+            AccessControlGroup.members, 'user_id'
+        ):
+            self.user_access_control_groups.setdefault(user_id, []).append(
+                self.access_control_groups[acl_id]
+            )
+        self.application_access_control_groups = {}
+        for acl_id, app_id in self._get_acl_relations(
+            AccessControlGroup.applications, 'application_id'
+        ):
+            self.application_access_control_groups.setdefault(
+                app_id, []
+            ).append(self.access_control_groups[acl_id])
+
+    def _get_acl_relations(self, field, column):
+        return (
+            field.through.objects
+            .using(DEFAULT_DB_ALIAS)
+            .values_list('accesscontrolgroup_id', column)
+        )
+
+
+def get_metadata():
+    """Get the up-to-date metadata snapshot
+
+    This is the entry point of this module.  It costs a single very cheap
+    query on the database to check for the version.
+    """
+    global _metadata
+
+    version = _get_metadata_version()
+    metadata = _metadata
+    if metadata is None or metadata.version != version:
+        with _metadata_lock:
+            if _metadata is None or _metadata.version != version:
+                _metadata = Metadata(version)
+            metadata = _metadata
+
+    return metadata
+
+
+def _get_metadata_version():
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT last_value FROM metadata_version')
+        return cursor.fetchone()[0]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [('serverdb', '0007_hostname_regex_hyphens')]
+    operations = [
+        # The processes cache the attributes and the servertypes.  This
+        # sequence is bumped every time they change to let the processes
+        # know that they need to reload them.  We start by calling it once,
+        # because the last value doesn't change after the first call.
+        migrations.RunSQL(
+            [
+                'CREATE SEQUENCE metadata_version',
+                "SELECT nextval('metadata_version')",
+            ],
+            'DROP SEQUENCE metadata_version',
+        ),
+    ]
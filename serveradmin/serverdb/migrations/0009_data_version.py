@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [('serverdb', '0008_metadata_version')]
+    operations = [
+        # The processes cache the query results.  This sequence is bumped
+        # every time the servers or their attributes change to let
+        # the processes know that they cannot use them anymore.  See
+        # the metadata_version for the details.
+        migrations.RunSQL(
+            [
+                'CREATE SEQUENCE data_version',
+                "SELECT nextval('data_version')",
+            ],
+            'DROP SEQUENCE data_version',
+        ),
+    ]
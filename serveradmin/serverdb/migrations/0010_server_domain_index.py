@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [('serverdb', '0009_data_version')]
+    operations = [
+        # Index the servers by the domain part of their hostnames to match
+        # them with the servers of the domain attributes.  The expression
+        # must be the same as the one used by the SQL generator.
+        migrations.RunSQL(
+            'CREATE INDEX server_hostname_domain ON server (('
+            "   CASE WHEN strpos(hostname, '.') > 1"
+            "   THEN substr(hostname, strpos(hostname, '.') + 1) END"
+            '))',
+            'DROP INDEX server_hostname_domain',
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [('serverdb', '0010_server_domain_index')]
+    operations = [
+        # Add a pg_trgm based trigram index on the string attribute values
+        # like the one on the server hostname for the regular expression
+        # and the substring searches.
+        migrations.RunSQL(
+            'CREATE EXTENSION IF NOT EXISTS pg_trgm', migrations.RunSQL.noop
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX server_string_attribute_value_trgm '
+            'ON server_string_attribute USING gin (value gin_trgm_ops)',
+            'DROP INDEX server_string_attribute_value_trgm',
+        ),
+        # The default index on the values cannot be used for the prefix
+        # searches unless the database uses the C collation.
+        migrations.RunSQL(
+            'CREATE INDEX server_string_attribute_value_pattern '
+            'ON server_string_attribute '
+            '   (attribute_id, value varchar_pattern_ops)',
+            'DROP INDEX server_string_attribute_value_pattern',
+        ),
+    ]
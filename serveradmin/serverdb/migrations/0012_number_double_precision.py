@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [('serverdb', '0011_string_attribute_pattern_indexes')]
+    operations = [
+        # The numbers are stored as double precision instead of numeric.
+        # It is much cheaper to compare and to decode, but it can only
+        # represent the integers exactly up to 2^53.  We refuse to migrate
+        # rather than silently changing the values out of this range.
+        migrations.RunSQL(
+            'DO $$ BEGIN'
+            '   IF EXISTS ('
+            '       SELECT 1'
+            '       FROM server_number_attribute'
+            '       WHERE abs(value) > 9007199254740992'
+            '   ) THEN'
+            "       RAISE EXCEPTION 'Number attribute values out of the "
+            "exact range of double precision';"
+            '   END IF;'
+            ' END $$',
+            migrations.RunSQL.noop,
+        ),
+        migrations.AlterField(
+            model_name='servernumberattribute',
+            name='value',
+            field=models.FloatField(),
+        ),
+    ]
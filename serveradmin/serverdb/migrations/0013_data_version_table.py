@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [('serverdb', '0012_number_double_precision')]
+    operations = [
+        # The version of the data is also read from the replicas.  The
+        # sequences are not replicated on every call, so the replicas
+        # would see the version change neither together with the data nor
+        # every time.  We keep it in a table with a single row instead,
+        # and update it within the same transactions as the data.
+        migrations.RunSQL(
+            [
+                'ALTER SEQUENCE data_version RENAME TO data_version_old',
+                'CREATE TABLE data_version (version bigint NOT NULL)',
+                'INSERT INTO data_version SELECT last_value'
+                ' FROM data_version_old',
+                'DROP SEQUENCE data_version_old',
+            ],
+            [
+                'ALTER TABLE data_version RENAME TO data_version_old',
+                'CREATE SEQUENCE data_version',
+                "SELECT setval('data_version', version)"
+                ' FROM data_version_old',
+                'DROP TABLE data_version_old',
+            ],
+        ),
+    ]
@@ -7,11 +7,14 @@ import re
 import json
 
 from distutils.util import strtobool
+from functools import partial
 from ipaddress import ip_address, ip_network
 
 from netaddr import EUI
 
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
 from django.utils.timezone import now, utc
@@ -21,6 +24,7 @@ import netfields
 
 from adminapi.datatype import STR_BASED_DATATYPES
 from serveradmin.apps.models import Application
+from serveradmin.serverdb.routers import remember_data_version
 
 ATTRIBUTE_TYPES = {
     'string': str,
@@ -296,6 +300,26 @@ class ServertypeAttribute(models.Model):
         super(ServertypeAttribute, self).clean()
 
 
+@receiver([post_save, post_delete], sender=Servertype)
+@receiver([post_save, post_delete], sender=Attribute)
+@receiver([post_save, post_delete], sender=ServertypeAttribute)
+def invalidate_metadata(sender, **kwargs):
+    """Bump the version to let all processes reload the metadata
+
+    The attributes, the servertypes and the relations between them are
+    cached by every process in serveradmin.serverdb.metadata.  We are
+    bumping the version after the current transaction is committed,
+    otherwise other processes can reload the metadata before they can
+    see the change, and keep using the old version.
+    """
+    transaction.on_commit(_bump_metadata_version)
+
+
+def _bump_metadata_version():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT nextval('metadata_version')")
+
+
 class Server(models.Model):
     """Servers are the main objects of the system.  They are stored in
     entity-attribute-value schema.  There are multiple models to store
@@ -325,51 +349,48 @@ class Server(models.Model):
 
     def clean(self, *args, **kwargs):
         super(Server, self).clean(*args, **kwargs)
+        self.validate_intern_ip()
+        if self.intern_ip is None:
+            return
+
+        # Check for other server with overlapping addresses
+        for server in Server.objects.filter(
+            intern_ip__net_overlaps=self.intern_ip
+        ).exclude(server_id=self.server_id):
+            self.validate_overlap(server.hostname, server.servertype)
+
+    def validate_intern_ip(self):
+        """Validate the IP address without querying the database"""
         if self.servertype.ip_addr_type == 'null':
             if self.intern_ip is not None:
                 raise ValidationError('IP address must be null.')
-        else:
-            if self.intern_ip is None:
-                raise ValidationError('IP address must not be null.')
-
-            if self.servertype.ip_addr_type == 'network':
-                self._validate_network_intern_ip()
-            else:
-                self._validate_host_intern_ip()
-
-    def _validate_host_intern_ip(self):
-        if self.intern_ip.max_prefixlen != self.netmask_len():
+        elif self.intern_ip is None:
+            raise ValidationError('IP address must not be null.')
+        elif self.servertype.ip_addr_type == 'network':
+            try:
+                ip_network(str(self.intern_ip))
+            except ValueError as error:
+                raise ValidationError(str(error))
+        elif self.intern_ip.max_prefixlen != self.netmask_len():
             raise ValidationError(
                 'Netmask length must be {0}.'
                 .format(self.intern_ip.max_prefixlen)
             )
 
-        # Check for other server with overlapping addresses
-        for server in Server.objects.filter(
-            intern_ip__net_overlaps=self.intern_ip
-        ).exclude(server_id=self.server_id):
-            if server.servertype.ip_addr_type == 'host':
-                raise ValidationError(
-                    'IP address already taken by the host "{0}".'
-                    .format(server.hostname)
-                )
-
-    def _validate_network_intern_ip(self):
-        try:
-            ip_network(str(self.intern_ip))
-        except ValueError as error:
-            raise ValidationError(str(error))
-
-        # Check for other server with overlapping addresses
-        for server in Server.objects.filter(
-            intern_ip__net_overlaps=self.intern_ip
-        ).exclude(server_id=self.server_id):
-            if self.servertype == server.servertype:
+    def validate_overlap(self, hostname, servertype):
+        """Validate the IP address against another server overlapping it"""
+        if self.servertype.ip_addr_type == 'network':
+            if self.servertype_id == servertype.pk:
                 raise ValidationError(
                     'IP address overlaps with "{0}" in the same '
                     'servertype.'
-                    .format(server.hostname)
+                    .format(hostname)
                 )
+        elif servertype.ip_addr_type == 'host':
+            raise ValidationError(
+                'IP address already taken by the host "{0}".'
+                .format(hostname)
+            )
 
     def netmask_len(self):
         return self.intern_ip.network.prefixlen
@@ -408,6 +429,16 @@ class ServerAttribute(models.Model):
         self.full_clean()
         self.save()
 
+    def clean_value(self, value):
+        """Validate and convert the value without querying the database
+
+        The committer uses this to validate all of the values before
+        writing them together.  Unlike full_clean(), it doesn't check
+        the uniqueness or the foreign keys.
+        """
+        self.value = value
+        self.clean_fields(exclude=['server', 'attribute'])
+
     @staticmethod
     def get_model(attribute_type):
         if attribute_type in 'string':
@@ -444,6 +475,14 @@ class ServerStringAttribute(ServerAttribute):
         index_together = [['attribute', 'value']]
 
     def save_value(self, value):
+        self._validate_value(value)
+        super().save_value(value)
+
+    def clean_value(self, value):
+        self._validate_value(value)
+        super().clean_value(value)
+
+    def _validate_value(self, value):
         for char in '\'"':
             if char in value:
                 raise ValidationError(
@@ -457,8 +496,6 @@ class ServerStringAttribute(ServerAttribute):
                     .format(value, datatype.__name__)
                 )
 
-        super().save_value(value)
-
 
 class ServerRelationAttributeManager(models.Manager):
     def get_queryset(self):
@@ -491,22 +528,37 @@ class ServerRelationAttribute(ServerAttribute):
         index_together = [['attribute', 'value']]
 
     def save_value(self, value):
-        target_servertype = self.attribute.target_servertype
-
-        try:
-            target_server = Server.objects.get(hostname=value)
-        except Server.DoesNotExist:
-            raise ValidationError(
-                'No server with hostname "{0}" exist.'.format(value)
-            )
+        ServerAttribute.save_value(self, self._get_target_server(value))
+
+    def clean_value(self, value):
+        # The target server is already validated to exist, so we don't
+        # need to validate the foreign key of the value.
+        self.value = self._get_target_server(value)
+        self.clean_fields(exclude=['server', 'attribute', 'value'])
+
+    def _get_target_server(self, value):
+        # The committer looks up the target servers of all of the values
+        # together, and passes the ones it has found.
+        if isinstance(value, Server):
+            target_server = value
+        else:
+            try:
+                target_server = Server.objects.get(hostname=value)
+            except Server.DoesNotExist:
+                raise ValidationError(
+                    'No server with hostname "{0}" exist.'.format(value)
+                )
 
-        if target_server.servertype != target_servertype:
+        if (
+            target_server.servertype_id !=
+            self.attribute.target_servertype_id
+        ):
             raise ValidationError(
                 'Attribute "{0}" has to be from servertype "{1}".'
                 .format(self.attribute, self.attribute.target_servertype)
             )
 
-        ServerAttribute.save_value(self, target_server)
+        return target_server
 
 
 class ServerBooleanAttribute(ServerAttribute):
@@ -531,6 +583,11 @@ class ServerBooleanAttribute(ServerAttribute):
         else:
             self.delete()
 
+    def clean_value(self, value):
+        # There is no value to validate.  The attribute is either there
+        # or not.
+        pass
+
 
 class ServerNumberAttribute(ServerAttribute):
     attribute = models.ForeignKey(
@@ -539,7 +596,7 @@ class ServerNumberAttribute(ServerAttribute):
         on_delete=models.CASCADE,
         limit_choices_to=dict(type='number'),
     )
-    value = models.DecimalField(max_digits=65, decimal_places=0)
+    value = models.FloatField()
 
     class Meta:
         app_label = 'serverdb'
@@ -548,11 +605,26 @@ class ServerNumberAttribute(ServerAttribute):
         index_together = [['attribute', 'value']]
 
     def get_value(self):
-        return (
-            int(self.value)
-            if self.value.as_tuple().exponent == 0
-            else float(self.value)
-        )
+        if isinstance(self.value, float) and self.value.is_integer():
+            return int(self.value)
+        return self.value
+
+    def save_value(self, value):
+        self._validate_value(value)
+        super().save_value(value)
+
+    def clean_value(self, value):
+        self._validate_value(value)
+        super().clean_value(value)
+
+    def _validate_value(self, value):
+        # The values are stored as double precision, which represents
+        # the integers exactly only up to 2^53.
+        if isinstance(value, int) and abs(value) > 2 ** 53:
+            raise ValidationError(
+                'Number attribute value {} is out of the exact range of '
+                '-2^53 to 2^53'.format(value)
+            )
 
 
 class ServerInetAttribute(ServerAttribute):
@@ -619,6 +691,39 @@ class ServerDateTimeAttribute(ServerAttribute):
         index_together = [['attribute', 'value']]
 
 
+@receiver([post_save, post_delete], sender=Server)
+@receiver(post_save, sender=ServerStringAttribute)
+@receiver(post_save, sender=ServerRelationAttribute)
+@receiver(post_save, sender=ServerBooleanAttribute)
+@receiver(post_save, sender=ServerNumberAttribute)
+@receiver(post_save, sender=ServerInetAttribute)
+@receiver(post_save, sender=ServerMACAddressAttribute)
+@receiver(post_save, sender=ServerDateAttribute)
+@receiver(post_save, sender=ServerDateTimeAttribute)
+def invalidate_data(sender=None, **kwargs):
+    """Bump the version to let all processes drop the cached query results
+
+    The changes to the servers through the query committer are already
+    taken care of by it, but the servers and their attributes can also be
+    changed in other ways, e.g. by the admin or the Graphite integration.
+    Unlike the metadata, the version of the data is also read from
+    the replicas, so we are bumping it within the current transaction for
+    them to see it together with the changes.  It is only remembered
+    after the transaction is committed.
+
+    We are not listening to the deletion of the attributes, because Django
+    would then have to fetch them before deleting them together with their
+    servers.  Outside of the query committer, they are only deleted through
+    the admin, which saves their server as well.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'UPDATE data_version SET version = version + 1 RETURNING version'
+        )
+        version = cursor.fetchone()[0]
+    transaction.on_commit(partial(remember_data_version, version))
+
+
 class Change(models.Model):
     change_on = models.DateTimeField(default=now, db_index=True)
     user = models.ForeignKey(User, null=True, on_delete=models.PROTECT)
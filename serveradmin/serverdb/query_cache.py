@@ -0,0 +1,84 @@
+"""Serveradmin - Query Result Cache
+
+Copyright (c) 2019 InnoGames GmbH
+"""
+# Many applications poll the same queries again and again.  We keep the
+# recent results in memory to serve them without touching the attribute
+# tables, as long as nothing has changed since.  All processes share a version
+# number for the data on the database.  It is bumped within the transaction
+# of every change (see invalidate_data() on the models), so the replicas
+# get it together with the changes.  We remember the versions together with
+# the results, and ignore them when they don't match anymore.
+#
+# The result objects are mutable, and the callers do modify them, so we
+# cannot give the same objects to multiple callers.  We keep a frozen copy
+# of the results in the cache instead, and give a new copy to every caller.
+
+import json
+from collections import namedtuple
+
+from django.conf import settings
+
+from adminapi.dataset import DatasetObject
+from adminapi.request import json_encode_extra
+from serveradmin.common.utils import LRUCache
+from serveradmin.serverdb.routers import get_read_connection
+
+_cache = LRUCache(settings.QUERY_CACHE_SIZE)
+
+_FrozenObject = namedtuple('_FrozenObject', ['object_id', 'items'])
+
+
+def get_cache_key(*args):
+    """Serialize the arguments of the query to use as the key"""
+    return json.dumps(args, default=json_encode_extra, sort_keys=True)
+
+
+def get_data_version():
+    """Get the version of the data
+
+    It must be called before the snapshot of the query is taken, so that
+    we wouldn't cache a result older than the version.  It is read from
+    the same database as the query.
+    """
+    with get_read_connection().cursor() as cursor:
+        cursor.execute('SELECT version FROM data_version')
+        return cursor.fetchone()[0]
+
+
+def get_cached_page(key, version):
+    """Get a new copy of the cached page, or None"""
+    entry = _cache.get(key)
+    if entry is None or entry[0] != version:
+        return None
+
+    page = entry[1]
+    return page._replace(objects=[_thaw(o) for o in page.objects])
+
+
+def set_cached_page(key, version, page):
+    if len(page.objects) > settings.QUERY_CACHE_MAX_OBJECTS:
+        return
+
+    page = page._replace(objects=tuple(_freeze(o) for o in page.objects))
+    _cache.set(key, (version, page))
+
+
+def _freeze(value):
+    if isinstance(value, DatasetObject):
+        return _FrozenObject(value.object_id, tuple(
+            (k, _freeze(v)) for k, v in value.items()
+        ))
+    if isinstance(value, (set, frozenset, list)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _thaw(value):
+    if isinstance(value, _FrozenObject):
+        return DatasetObject(
+            ((k, _thaw(v)) for k, v in value.items), value.object_id
+        )
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    return value
@@ -5,16 +5,17 @@ Copyright (c) 2019 InnoGames GmbH
 
 import json
 import logging
+from collections import Counter, defaultdict
 from itertools import chain
 
 from django.core.exceptions import PermissionDenied, ValidationError
-from django.db import IntegrityError, transaction
+from django.db import IntegrityError, connection, transaction
 from django.dispatch.dispatcher import Signal
 
 from adminapi.dataset import DatasetCommit
 from adminapi.request import json_encode_extra
+from serveradmin.serverdb.metadata import get_metadata
 from serveradmin.serverdb.models import (
-    Servertype,
     Attribute,
     Server,
     ServerAttribute,
@@ -23,6 +24,7 @@ from serveradmin.serverdb.models import (
     ChangeCommit,
     ChangeUpdate,
     ChangeDelete,
+    invalidate_data,
 )
 from serveradmin.serverdb.query_materializer import (
     QueryMaterializer,
@@ -34,6 +36,19 @@ post_commit = Signal()
 
 logger = logging.getLogger(__name__)
 
+# The attribute values are written to their tables by passing them as
+# arrays.  These are the types to cast them to.  The relations are written
+# with the identifiers of their target servers.
+_VALUE_TYPES = {
+    'string': 'text',
+    'relation': 'integer',
+    'number': 'double precision',
+    'inet': 'inet',
+    'macaddr': 'macaddr',
+    'date': 'date',
+    'datetime': 'timestamp with time zone',
+}
+
 
 class CommitError(ValidationError):
     pass
@@ -57,7 +72,14 @@ class CommitNewerData(CommitError):
 
 
 def commit_query(created=[], changed=[], deleted=[], app=None, user=None):
-    """The main function to commit queries"""
+    """The main function to commit queries
+
+    The returned commit holds the created and the deleted objects with all
+    of their attributes.  The changed objects hold only the attributes
+    the commit has looked at: the special ones, the changed ones, the ones
+    related via them and the ones the ACLs are filtering on.  They should
+    be queried again, if the others are needed.
+    """
 
     if not user:
         user = app.owner
@@ -66,38 +88,53 @@ def commit_query(created=[], changed=[], deleted=[], app=None, user=None):
         commit_query, created=created, changed=changed, deleted=deleted
     )
 
-    # TODO: Find out which attributes we actually need
-    attribute_lookup = {a.pk: a for a in Attribute.objects.all()}
-    joined_attributes = {
-        a: None
-        for a
-        in list(attribute_lookup.values()) + list(Attribute.specials.values())
-    }
+    metadata = get_metadata()
+    attribute_lookup = metadata.attributes
+    entities = _get_entities(metadata, user, app)
+
+    # The created and the deleted servers are logged with all of their
+    # attributes, and the ACLs compare all of them to the defaults.  For
+    # the changed ones, we only need the attributes which are changed
+    # together with the ones the ACLs are filtering on.
+    all_attributes = {a: None for a in metadata.attribute_lookup.values()}
+    changed_attributes = _get_changed_attributes(metadata, changed, entities)
 
     with transaction.atomic():
         change_commit = ChangeCommit.objects.create(app=app, user=user)
         changed_servers = _fetch_servers(set(c['object_id'] for c in changed))
-        unchanged_objects = _materialize(changed_servers, joined_attributes)
+        unchanged_objects = _materialize(
+            changed_servers, changed_attributes, metadata
+        )
 
         deleted_servers = _fetch_servers(deleted)
-        deleted_objects = _materialize(deleted_servers, joined_attributes)
-        _validate(attribute_lookup, changed, unchanged_objects)
+        deleted_objects = _materialize(
+            deleted_servers, all_attributes, metadata
+        )
+        _validate(metadata, changed, unchanged_objects)
+        deletes, removes, inserts = _get_attribute_writes(
+            attribute_lookup, changed
+        )
 
         # Changes should be applied in order to prevent integrity errors.
-        _delete_attributes(attribute_lookup, changed, changed_servers, deleted)
+        _delete_attributes(deletes, removes, deleted)
         _delete_servers(changed, deleted, deleted_servers)
-        created_servers = _create_servers(attribute_lookup, created)
-        created_objects = _materialize(created_servers, joined_attributes)
+        created_servers = _create_servers(metadata, created)
+        created_objects = _materialize(
+            created_servers, all_attributes, metadata
+        )
         _update_servers(changed, changed_servers)
-        _upsert_attributes(attribute_lookup, changed, changed_servers)
-        changed_objects = _materialize(changed_servers, joined_attributes)
+        _insert_attributes(attribute_lookup, inserts)
+        changed_objects = _materialize(
+            changed_servers, changed_attributes, metadata
+        )
 
         _access_control(
-            user, app, unchanged_objects,
+            metadata, entities, unchanged_objects,
             created_objects, changed_objects, deleted_objects
         )
 
         _log_changes(change_commit, changed, created_objects, deleted_objects)
+        invalidate_data()
 
     post_commit.send_robust(
         commit_query, created=created, changed=changed, deleted=deleted
@@ -110,8 +147,11 @@ def commit_query(created=[], changed=[], deleted=[], app=None, user=None):
     )
 
 
-def _validate(attribute_lookup, changed, changed_objects):
-    servertype_attributes = _get_servertype_attributes(changed_objects)
+def _validate(metadata, changed, changed_objects):
+    attribute_lookup = metadata.attributes
+    servertype_attributes = _get_servertype_attributes(
+        metadata, changed_objects
+    )
 
     # Attributes must be always validated
     violations_attribs = _validate_attributes(
@@ -149,7 +189,108 @@ def _validate(attribute_lookup, changed, changed_objects):
         raise CommitNewerData('Newer data available', newer)
 
 
-def _delete_attributes(attribute_lookup, changed, changed_servers, deleted):
+def _get_attribute_writes(attribute_lookup, changed):
+    """Validate the changes of the attributes and group them by type
+
+    All of the values are validated in memory before anything is written,
+    so that we can write them together with a few statements for every
+    attribute table.  Only the relations are validated when they are
+    inserted, as their targets can be created by the same commit.
+    The single values are replaced by deleting the old one and inserting
+    the new one.  Returns the rows to delete, the values to remove and
+    the values to insert by the attribute types.
+    """
+    deletes = {}
+    removes = {}
+    inserts = {}
+    for changes in changed:
+        object_id = changes['object_id']
+
+        for attribute_id, change in changes.items():
+            if attribute_id in Attribute.specials:
+                continue
+
+            attribute = attribute_lookup[attribute_id]
+            row = (object_id, attribute_id)
+            action = change['action']
+            if action == 'multi':
+                removes.setdefault(attribute.type, []).extend(
+                    row + (_get_removed_value(attribute, v), )
+                    for v in change['remove']
+                )
+                values = change['add']
+            else:
+                deletes.setdefault(attribute.type, []).append(row)
+                if action == 'delete' or change['new'] is None:
+                    continue
+                values = [change['new']]
+
+            inserts.setdefault(attribute.type, []).extend(
+                _get_insert_rows(attribute, row, values)
+            )
+
+    return deletes, removes, inserts
+
+
+def _get_insert_rows(attribute, row, values):
+    for value in values:
+        if attribute.type == 'boolean':
+            if value:
+                yield row
+        elif attribute.type == 'relation':
+            # They are resolved all together by _insert_attributes().
+            yield row + (value, )
+        else:
+            yield row + (_get_db_value(attribute, value), )
+
+
+def _resolve_relations(attribute_lookup, rows):
+    """Resolve the hostnames of the relation targets with a single query
+
+    The values are then validated with the servers we have found.
+    The hostnames which we couldn't find are passed as they are to
+    get the same error as before.
+    """
+    targets = {
+        s.hostname: s
+        for s in Server.objects.filter(hostname__in={r[2] for r in rows})
+    }
+
+    return [
+        (object_id, attribute_id, _get_db_value(
+            attribute_lookup[attribute_id], targets.get(hostname, hostname)
+        ))
+        for object_id, attribute_id, hostname in rows
+    ]
+
+
+def _get_db_value(attribute, value):
+    model = ServerAttribute.get_model(attribute.type)
+    server_attribute = model(attribute=attribute)
+    server_attribute.clean_value(value)
+    field = model._meta.get_field('value')
+
+    return field.get_db_prep_save(
+        getattr(server_attribute, field.attname), connection
+    )
+
+
+def _get_removed_value(attribute, value):
+    # The relations are removed by the hostnames of their targets.
+    if attribute.type == 'relation':
+        return value
+
+    field = ServerAttribute.get_model(attribute.type)._meta.get_field('value')
+    return field.get_db_prep_save(field.to_python(value), connection)
+
+
+def _get_columns(rows):
+    # The columns are passed as arrays.  We cannot use tuples, because
+    # they are adapted as records.
+    return [list(c) for c in zip(*rows)]
+
+
+def _delete_attributes(deletes, removes, deleted):
     # We first have to delete all of the relation attributes
     # to avoid integrity errors.  Other attributes will just go away
     # with the servers.
@@ -160,28 +301,41 @@ def _delete_attributes(attribute_lookup, changed, changed_servers, deleted):
             .delete()
         )
 
-    for changes in changed:
-        object_id = changes['object_id']
+    with connection.cursor() as cursor:
+        for attribute_type, rows in deletes.items():
+            table = ServerAttribute.get_model(attribute_type)._meta.db_table
+            cursor.execute(
+                'DELETE FROM {0} AS a'
+                ' USING unnest(%s::integer[], %s::text[])'
+                '   AS d(server_id, attribute_id)'
+                ' WHERE a.server_id = d.server_id'
+                '   AND a.attribute_id = d.attribute_id'
+                .format(table),
+                _get_columns(rows),
+            )
 
-        for attribute_id, change in changes.items():
-            if attribute_id in Attribute.specials:
+        for attribute_type, rows in removes.items():
+            if not rows:
                 continue
-
-            server = changed_servers[object_id]
-            attribute = attribute_lookup[attribute_id]
-            action = change['action']
-
-            if action == 'delete' or (
-                action == 'update' and change['new'] is None
-            ):
-                server.get_attributes(attribute).delete()
-            elif action == 'multi' and change['remove']:
-                for server_attribute in server.get_attributes(attribute):
-                    value = server_attribute.get_value()
-                    if isinstance(value, Server):
-                        value = value.hostname
-                    if value in change['remove']:
-                        server_attribute.delete()
+            table = ServerAttribute.get_model(attribute_type)._meta.db_table
+            if attribute_type == 'relation':
+                value_type = 'text'
+                value_sql = (
+                    '(SELECT server_id FROM server WHERE hostname = d.value)'
+                )
+            else:
+                value_type = _VALUE_TYPES[attribute_type]
+                value_sql = 'd.value'
+            cursor.execute(
+                'DELETE FROM {0} AS a'
+                ' USING unnest(%s::integer[], %s::text[], %s::{1}[])'
+                '   AS d(server_id, attribute_id, value)'
+                ' WHERE a.server_id = d.server_id'
+                '   AND a.attribute_id = d.attribute_id'
+                '   AND a.value = {2}'
+                .format(table, value_type, value_sql),
+                _get_columns(rows),
+            )
 
 
 def _delete_servers(changed, deleted, deleted_servers):
@@ -203,8 +357,18 @@ def _delete_servers(changed, deleted, deleted_servers):
             del changed[server_id]
 
 
-def _create_servers(attribute_lookup, created):
-    created_servers = {}
+def _create_servers(metadata, created):
+    """Create the servers together with their attributes
+
+    All of the new servers and their attributes are validated in memory
+    before anything is written.  The hostnames are checked with a single
+    query.  The IP addresses and the relations are checked after the
+    servers are inserted, so that the new servers are checked against
+    each other, and can be related to each other.
+    """
+    attribute_lookup = metadata.attributes
+    servers = []
+    inserts = {}
     for attributes in created:
         if 'hostname' not in attributes:
             raise CommitError('"hostname" attribute is required.')
@@ -212,25 +376,77 @@ def _create_servers(attribute_lookup, created):
 
         if 'servertype' not in attributes:
             raise CommitError('"servertype" attribute is required.')
-        servertype = _get_servertype(attributes)
+        servertype = _get_servertype(metadata, attributes)
 
         if 'intern_ip' not in attributes:
             raise CommitError('"intern_ip" attribute is required.')
         intern_ip = attributes['intern_ip']
 
         attributes = dict(_get_real_attributes(attributes, attribute_lookup))
-        _validate_real_attributes(servertype, attributes)
+        _validate_real_attributes(metadata, servertype, attributes)
+
+        server = Server(
+            hostname=hostname, intern_ip=intern_ip, servertype=servertype
+        )
+        server.clean_fields(exclude=['servertype'])
+        server.validate_intern_ip()
+        servers.append(server)
+
+        # The rows are identified by the servers until they are inserted.
+        for attribute, value in attributes.items():
+            inserts.setdefault(attribute.type, []).extend(_get_insert_rows(
+                attribute,
+                (server, attribute.pk),
+                value if attribute.multi else [value],
+            ))
+
+    _validate_hostnames(servers)
+    Server.objects.bulk_create(servers)
+    _validate_intern_ips(metadata, servers)
+
+    _insert_attributes(attribute_lookup, {
+        attribute_type: [(r[0].server_id, ) + r[1:] for r in rows]
+        for attribute_type, rows in inserts.items()
+    })
+
+    return {s.server_id: s for s in servers}
+
+
+def _validate_hostnames(servers):
+    hostnames = [s.hostname for s in servers]
+    if (
+        len(set(hostnames)) != len(hostnames) or
+        Server.objects.filter(hostname__in=hostnames).exists()
+    ):
+        raise CommitError('Server with that hostname already exists')
 
-        server = _insert_server(hostname, intern_ip, servertype, attributes)
 
-        created_server = {k.pk: v for k, v in attributes.items()}
-        created_server['hostname'] = hostname
-        created_server['servertype'] = servertype.pk
-        created_server['intern_ip'] = intern_ip
+def _validate_intern_ips(metadata, servers):
+    """Validate the new servers against the ones overlapping them
 
-        created_servers[server.server_id] = server
+    We find the overlapping servers of all of the new ones with a single
+    query.  Their servertypes are taken from the metadata.
+    """
+    servers = [s for s in servers if s.intern_ip is not None]
+    if not servers:
+        return
 
-    return created_servers
+    server_lookup = {s.server_id: s for s in servers}
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT created.server_id, server.hostname, server.servertype_id'
+            ' FROM unnest(%s::integer[], %s::inet[])'
+            '   AS created(server_id, intern_ip)'
+            ' JOIN server ON server.intern_ip && created.intern_ip'
+            '   AND server.server_id != created.server_id',
+            _get_columns(
+                (s.server_id, str(s.intern_ip)) for s in servers
+            ),
+        )
+        for server_id, hostname, servertype_id in cursor.fetchall():
+            server_lookup[server_id].validate_overlap(
+                hostname, metadata.servertypes[servertype_id]
+            )
 
 
 def _update_servers(changed, changed_servers):
@@ -256,38 +472,59 @@ def _update_servers(changed, changed_servers):
         server.save()
 
 
-def _upsert_attributes(attribute_lookup, changed, changed_servers):
-    for changes in changed:
-        object_id = changes['object_id']
+def _insert_attributes(attribute_lookup, inserts):
+    # The relations are resolved just before they are inserted, so that
+    # they can point to the servers created by the same commit.
+    if inserts.get('relation'):
+        inserts['relation'] = _resolve_relations(
+            attribute_lookup, inserts['relation']
+        )
 
-        for attribute_id, change in changes.items():
-            if attribute_id in Attribute.specials:
+    # The values which are already there are not inserted, so that the
+    # others can be compared with the returned rows.  They can only be
+    # the ones added to the multi attributes, because the single values
+    # are deleted before they are inserted again.
+    with connection.cursor() as cursor:
+        for attribute_type, rows in inserts.items():
+            if not rows:
                 continue
+            table = ServerAttribute.get_model(attribute_type)._meta.db_table
+            if attribute_type == 'boolean':
+                cursor.execute(
+                    'INSERT INTO {0} (server_id, attribute_id)'
+                    ' SELECT * FROM unnest(%s::integer[], %s::text[])'
+                    ' ON CONFLICT DO NOTHING'
+                    ' RETURNING server_id, attribute_id'
+                    .format(table),
+                    _get_columns(rows),
+                )
+            else:
+                cursor.execute(
+                    'INSERT INTO {0} (server_id, attribute_id, value)'
+                    ' SELECT * FROM unnest('
+                    '   %s::integer[], %s::text[], %s::{1}[]'
+                    ' )'
+                    ' ON CONFLICT DO NOTHING'
+                    ' RETURNING server_id, attribute_id'
+                    .format(table, _VALUE_TYPES[attribute_type]),
+                    _get_columns(rows),
+                )
+            _check_inserted(rows, cursor.fetchall())
 
-            attribute = attribute_lookup[attribute_id]
-            server = changed_servers[object_id]
-
-            action = change['action']
-            if action == 'multi':
-                for value in change['add']:
-                    server.add_attribute(attribute, value)
-                continue
 
-            if action not in ('new', 'update'):
-                continue
-            if change['new'] is None:
-                continue
-
-            try:
-                server_attribute = server.get_attributes(attribute).get()
-            except ServerAttribute.get_model(attribute.type).DoesNotExist:
-                server.add_attribute(attribute, change['new'])
-            else:
-                server_attribute.save_value(change['new'])
+def _check_inserted(rows, inserted_rows):
+    conflicts = Counter(row[:2] for row in rows)
+    conflicts.subtract(tuple(row) for row in inserted_rows)
+    for (server_id, attribute_id), count in conflicts.items():
+        if count > 0:
+            raise CommitError(
+                'Attribute "{}" of object {} already has the value to '
+                'be added.'.format(attribute_id, server_id)
+            )
 
 
 def _access_control(
-    user, app, unchanged_objects,
+    metadata, entities, unchanged_objects,
     created_objects, changed_objects, deleted_objects,
 ):
     """Enforce serveradmin ACLs
@@ -308,19 +545,26 @@ def _access_control(
     its ACLs, the error message can become rather complex, listing all the
     reasons all the users ACLs were not applicable.
 
+    Note: The ACLs are compiled once by the metadata cache, and the
+    defaults of the servertypes are computed once per commit, so checking
+    the objects doesn't query the database.
+
     Raises PermissionDenied if a change is not permissible.
     Returns None on success.
     """
 
-    entities = []
-    if not user.is_superuser:
-        entities.append(
-            ('user', user, list(user.access_control_groups.all()))
-        )
-    if app and not app.superuser:
-        entities.append(
-            ('application', app, list(app.access_control_groups.all()))
-        )
+    if not entities:
+        return
+
+    # For existing objects we only check attributes which were changed
+    # For new objects we only check attributes different to their default
+    default_objects = {
+        servertype_id: get_default_attribute_values(servertype_id, metadata)
+        for servertype_id in {
+            o['servertype']
+            for o in chain(created_objects.values(), deleted_objects.values())
+        }
+    }
 
     # Check all objects touched by this commit
     for obj in chain(
@@ -328,11 +572,16 @@ def _access_control(
         changed_objects.values(),
         deleted_objects.values(),
     ):
+        if obj['object_id'] in unchanged_objects:
+            old_object = unchanged_objects[obj['object_id']]
+        else:
+            old_object = default_objects[obj['servertype']]
+
         # Check both the user and, if applicable, the users app
         # If either doesn't have the necessary rights, abort the commit
         for entity_class, entity_name, groups in entities:
             acl_violations = {
-                acl: _acl_violations(unchanged_objects, obj, acl)
+                acl: _acl_violations(old_object, obj, acl)
                 for acl in groups
             }
 
@@ -350,7 +599,75 @@ def _access_control(
                 raise PermissionDenied(msg)
 
 
-def _acl_violations(changed_objects, obj, acl):
+def _get_entities(metadata, user, app):
+    """Get the user and the app with their ACLs to check the commit"""
+    entities = []
+    if not user.is_superuser:
+        entities.append((
+            'user', user,
+            metadata.user_access_control_groups.get(user.pk, []),
+        ))
+    if app and not app.superuser:
+        entities.append((
+            'application', app,
+            metadata.application_access_control_groups.get(app.pk, []),
+        ))
+
+    return entities
+
+
+def _get_changed_attributes(metadata, changed, entities):
+    """Get the attributes to materialize the changed servers with
+
+    These are the attributes being changed, the ones derived from them,
+    as they change together, and the ones the ACLs are filtering on.
+    The special attributes are always included.
+    """
+    attribute_ids = _get_dependent_attribute_ids(
+        metadata, {a for changes in changed for a in changes}
+    )
+    attribute_ids.update(Attribute.specials)
+    for entity_class, entity_name, groups in entities:
+        for acl in groups:
+            attribute_ids.update(acl.get_filters())
+
+    return {
+        metadata.attribute_lookup[attribute_id]: None
+        for attribute_id in attribute_ids
+        if attribute_id in metadata.attribute_lookup
+    }
+
+
+def _get_dependent_attribute_ids(metadata, attribute_ids):
+    """Get the given attributes together with all derived from them
+
+    The supernets are derived from the "intern_ip", the domains from
+    the "hostname", and the attributes related via another one from it.
+    They can be derived from the derived ones again.
+    """
+    dependents = defaultdict(set)
+    for attribute in metadata.attributes.values():
+        if attribute.type == 'supernet':
+            dependents['intern_ip'].add(attribute.attribute_id)
+        elif attribute.type == 'domain':
+            dependents['hostname'].add(attribute.attribute_id)
+    for servertype_attributes in metadata.servertype_attributes.values():
+        for sa in servertype_attributes.values():
+            if sa.related_via_attribute_id:
+                dependents[sa.related_via_attribute_id].add(sa.attribute_id)
+
+    result = set()
+    stack = list(attribute_ids)
+    while stack:
+        attribute_id = stack.pop()
+        if attribute_id not in result:
+            result.add(attribute_id)
+            stack.extend(dependents[attribute_id])
+
+    return result
+
+
+def _acl_violations(old_object, obj, acl):
     """Check if ACL allows all the changes to obj
 
     An ACL can fail to validate in two ways.  Every ACL has a filter describing
@@ -383,13 +700,6 @@ def _acl_violations(changed_objects, obj, acl):
     if violations:
         return violations
 
-    # For existing objects we only check attributes which were changed
-    # For new objects we only check attributes different to their default
-    if obj['object_id'] in changed_objects:
-        old_object = changed_objects[obj['object_id']]
-    else:
-        old_object = get_default_attribute_values(obj['servertype'])
-
     # Gather attribute ids this ACL allows changing
     attribute_ids = acl.get_permissible_attribute_ids()
 
@@ -410,30 +720,30 @@ def _acl_violations(changed_objects, obj, acl):
 
 
 def _log_changes(commit, changed, created_objects, deleted_objects):
-    for updates in changed:
-        ChangeUpdate.objects.create(
+    ChangeUpdate.objects.bulk_create(
+        ChangeUpdate(
             commit=commit,
             server_id=updates['object_id'],
             updates_json=json.dumps(updates, default=json_encode_extra),
         )
-
-    for attributes in deleted_objects.values():
-        attributes_json = json.dumps(attributes, default=json_encode_extra)
-        ChangeDelete.objects.create(
+        for updates in changed
+    )
+    ChangeDelete.objects.bulk_create(
+        ChangeDelete(
             commit=commit,
             server_id=attributes['object_id'],
-            attributes_json=attributes_json,
-        )
-
-    for obj in created_objects.values():
-        attributes_json = json.dumps(
-            obj, default=json_encode_extra
+            attributes_json=json.dumps(attributes, default=json_encode_extra),
         )
-        ChangeAdd.objects.create(
+        for attributes in deleted_objects.values()
+    )
+    ChangeAdd.objects.bulk_create(
+        ChangeAdd(
             commit=commit,
             server_id=obj['object_id'],
-            attributes_json=attributes_json,
+            attributes_json=json.dumps(obj, default=json_encode_extra),
         )
+        for obj in created_objects.values()
+    )
 
 
 def _fetch_servers(object_ids):
@@ -450,21 +760,20 @@ def _fetch_servers(object_ids):
     return servers
 
 
-def _materialize(servers, joined_attributes):
+def _materialize(servers, joined_attributes, metadata):
     return {
         o['object_id']: o
-        for o in QueryMaterializer(list(servers.values()), joined_attributes)
+        for o in QueryMaterializer(
+            list(servers.values()), joined_attributes, metadata=metadata
+        )
     }
 
 
-def _get_servertype_attributes(servers):
-    servertype_attributes = dict()
-    for servertype_id in {s['servertype'] for s in servers.values()}:
-        servertype_attributes[servertype_id] = dict()
-        for sa in Servertype.objects.get(pk=servertype_id).attributes.all():
-            servertype_attributes[servertype_id][sa.attribute_id] = sa
-
-    return servertype_attributes
+def _get_servertype_attributes(metadata, servers):
+    return {
+        servertype_id: metadata.servertype_attributes[servertype_id]
+        for servertype_id in {s['servertype'] for s in servers.values()}
+    }
 
 
 def _validate_attributes(changes, servers, servertype_attributes):
@@ -602,10 +911,10 @@ def _build_error_message(violations_attribs, violations_readonly,
     return '. '.join(message)
 
 
-def _get_servertype(attributes):
+def _get_servertype(metadata, attributes):
     try:
-        return Servertype.objects.get(pk=attributes['servertype'])
-    except Servertype.DoesNotExist:
+        return metadata.servertypes[attributes['servertype']]
+    except KeyError:
         raise CommitError('Unknown servertype: ' + attributes['servertype'])
 
 
@@ -642,11 +951,13 @@ def _get_real_attributes(attributes, attribute_lookup):
         yield attribute, value
 
 
-def _validate_real_attributes(servertype, real_attributes):     # NOQA: C901
+def _validate_real_attributes(                                   # NOQA: C901
+    metadata, servertype, real_attributes
+):
     violations_regexp = []
     violations_required = []
     servertype_attributes = set()
-    for sa in servertype.attributes.all():
+    for sa in metadata.servertype_attributes[servertype.pk].values():
         attribute = sa.attribute
         servertype_attributes.add(attribute)
 
@@ -695,29 +1006,6 @@ def _validate_real_attributes(servertype, real_attributes):     # NOQA: C901
     )
 
 
-def _insert_server(hostname, intern_ip, servertype, attributes):
-
-    if Server.objects.filter(hostname=hostname).exists():
-        raise CommitError('Server with that hostname already exists')
-
-    server = Server.objects.create(
-        hostname=hostname,
-        intern_ip=intern_ip,
-        servertype=servertype,
-    )
-    server.full_clean()
-    server.save()
-
-    for attribute, value in attributes.items():
-        if attribute.multi:
-            for single_value in value:
-                server.add_attribute(attribute, single_value)
-        else:
-            server.add_attribute(attribute, value)
-
-    return server
-
-
 def handle_violations(
     violations_regexp,
     violations_required,
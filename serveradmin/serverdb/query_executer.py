@@ -3,17 +3,328 @@
 Copyright (c) 2019 InnoGames GmbH
 """
 
+import json
+from hashlib import sha1
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
+from itertools import islice
+
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
-from django.db import DataError, connection, transaction
+from django.db import DataError, transaction
 
 from adminapi.filters import Any
-from serveradmin.serverdb.models import Attribute, ServertypeAttribute, Server
-from serveradmin.serverdb.sql_generator import get_server_query
+from serveradmin.serverdb.filter_optimizer import (
+    get_filter_cost,
+    optimize_filter,
+)
+from serveradmin.serverdb.metadata import get_metadata
+from serveradmin.serverdb.models import Attribute, Server
+from serveradmin.serverdb.query_cache import (
+    get_cache_key,
+    get_cached_page,
+    get_data_version,
+    set_cached_page,
+)
+from serveradmin.serverdb.sql_generator import (
+    get_server_count_query,
+    get_server_query,
+)
 from serveradmin.serverdb.query_materializer import QueryMaterializer
+from serveradmin.serverdb.routers import (
+    choose_read_alias,
+    get_read_alias,
+    get_read_connection,
+    read_replica,
+)
+
+QueryPage = namedtuple('QueryPage', ['objects', 'total_count', 'after'])
+
+
+def execute_query(
+    filters, restrict, order_by, limit=None, offset=0, after=None
+):
+    """The main function to execute queries
+
+    The limit and the offset are applied after the ordering.  See
+    execute_query_page() for the "after" argument.
+    """
+    return _execute_query(
+        filters, restrict, order_by, limit, offset, after, False
+    ).objects
+
+
+def execute_query_page(
+    filters, restrict, order_by, limit=None, offset=0, after=None
+):
+    """Execute the query to get a page of the result
+
+    It returns the total count of the matching objects together with a
+    cursor to get the next page.  The cursor is an opaque string to be
+    passed as "after" to continue right after the last object of this page.
+    It is None after the last page.  Unlike the offset, the cursor doesn't
+    make the database skip through the previous pages.  It is only supported
+    with the default ordering by the hostname.  We don't count the objects
+    when a cursor is given, because the callers walking through the pages
+    wouldn't need it on every page.
+    """
+    return _execute_query(
+        filters, restrict, order_by, limit, offset, after, after is None
+    )
+
+
+def get_query_etag(
+    filters, restrict, order_by, limit=None, offset=0, after=None
+):
+    """Get an identifier for the result of the query as it is now
+
+    It is derived from the query and the versions of the data and of
+    the metadata, so it changes whenever anything that could affect
+    the result changes.  It must be called before the query is executed,
+    so that it wouldn't be newer than the result.  It is meant to be used
+    as the ETag of the HTTP responses.
+    """
+    key = get_cache_key(filters, restrict, order_by, limit, offset, after)
+    with read_replica():
+        version = (get_data_version(), get_metadata().version)
+
+    return sha1('{}:{}:{}'.format(key, *version).encode()).hexdigest()
+
+
+@read_replica()
+def _execute_query(filters, restrict, order_by, limit, offset, after, count):
+    """Execute the query or get its result from the cache
+
+    See the query cache module for its details.  The query runs on one of
+    the replicas of the database, if they are configured.  See the routers
+    module for the details.
+    """
+    # The attributes, the servertypes and the relations between them are
+    # cached in memory.  We can get them before starting the database
+    # transaction, because the metadata is mostly stable, and the data model
+    # wouldn't let us see anything in inconsistent state, even while it is
+    # being changed concurrently.
+    metadata = get_metadata()
+
+    if not settings.QUERY_CACHE_SIZE:
+        return _run_query(
+            metadata, filters, restrict, order_by, limit, offset, after, count
+        )
+
+    # The key has to be calculated before anything modifies the arguments.
+    # The version has to be read before the snapshot is taken.
+    key = get_cache_key(
+        filters, restrict, order_by, limit, offset, after, count
+    )
+    version = (get_data_version(), metadata.version)
+
+    page = get_cached_page(key, version)
+    if page is None:
+        page = _run_query(
+            metadata, filters, restrict, order_by, limit, offset, after, count
+        )
+        set_cached_page(key, version, page)
+
+    return page
+
+
+def _run_query(
+    metadata, filters, restrict, order_by, limit, offset, after, count
+):
+    if after is not None:
+        after = _decode_cursor(after, order_by)
+
+    filters, related_vias, materializer_args = _prepare_query(
+        metadata, filters, restrict, order_by
+    )
+    materializer_args, sql_order_by = _push_order_by(
+        materializer_args, metadata
+    )
+
+    # REPEATABLE READ isolation level ensures Postgres to give us a consistent
+    # snapshot for the database transaction.  We also set READ ONLY as this
+    # is a query operation.  Perhaps this is also enabling some optimization
+    # on the Postgres side.
+    with transaction.atomic(using=get_read_alias()):
+        _set_transaction_read_only()
+
+        # The actual query execution procedure is 2 steps: first filtering
+        # the objects, and then materializing the requested attributes.
+        # The joined attributes are also handled on the materialization
+        # step.  Ordering by the attributes which cannot be ordered on
+        # the database has to be handled by it, because some properties of
+        # the attribute values which might be relevant for ordering may be
+        # lost after the materialization.  See the query materializer module
+        # for its details.  The functions on this module continues with
+        # the filtering step.
+        #
+        # If the servers are ordered on the database, we can let it apply
+        # the limit and the offset.
+        #
+        # The materializer can join the attributes with the same query
+        # instead of getting the identifiers of the servers sent back,
+        # unless we take only a part of its result.  We don't let it
+        # order the servers again either.
+        if order_by is None or sql_order_by is not None:
+            servers, server_query = _get_servers(
+                filters,
+                metadata,
+                related_vias,
+                limit,
+                offset,
+                after,
+                sql_order_by,
+            )
+            if sql_order_by:
+                server_query = None
+        else:
+            servers, server_query = _get_servers(
+                filters, metadata, related_vias
+            )
+            if limit is not None or offset:
+                servers = _get_servers_page(
+                    servers, materializer_args[1], limit, offset, metadata
+                )
+                server_query = None
+        objects = list(QueryMaterializer(
+            servers,
+            *materializer_args,
+            metadata=metadata,
+            server_query=server_query
+        ))
+
+        if not count:
+            total_count = None
+        elif limit is None and not offset:
+            total_count = len(objects)
+        else:
+            total_count = _count_servers(filters, metadata, related_vias)
 
+    return QueryPage(
+        objects, total_count, _get_next_cursor(servers, order_by, limit)
+    )
 
-def execute_query(filters, restrict, order_by):
-    """The main function to execute queries"""
+
+def stream_query(filters, restrict, order_by, batch_size=1000):
+    """Execute the query to get the objects in batches
+
+    This is an alternative to execute_query() to use for the large results.
+    The servers are fetched from the database in batches, and only a batch
+    of them is materialized at a time.  It returns a generator yielding lists
+    of objects.  The filters are prepared eagerly, so that the errors about
+    them are raised by this function.
+    """
+    metadata = get_metadata()
+    filters, related_vias, materializer_args = _prepare_query(
+        metadata, filters, restrict, order_by
+    )
+    materializer_args, sql_order_by = _push_order_by(
+        materializer_args, metadata
+    )
+    attribute_filters = _get_attribute_filters(
+        filters, metadata.attribute_lookup
+    )
+    if attribute_filters is None:
+        return iter(())
+
+    return _stream_objects(
+        attribute_filters, related_vias, materializer_args, metadata,
+        batch_size, sql_order_by,
+    )
+
+
+def _stream_objects(
+    attribute_filters,
+    related_vias,
+    materializer_args,
+    metadata,
+    batch_size,
+    sql_order_by,
+):
+    # The transaction is kept open until the generator is exhausted
+    # or closed, so all of the batches come from the same snapshot.
+    # The reads are routed to the chosen database only while we are working
+    # on a batch, and not while the caller is working on it.
+    alias = choose_read_alias()
+    with transaction.atomic(using=alias):
+        with read_replica(alias):
+            _set_transaction_read_only()
+
+            if len(materializer_args) == 1:
+                batches = _stream_servers(
+                    attribute_filters,
+                    related_vias,
+                    metadata,
+                    batch_size,
+                    sql_order_by,
+                )
+            else:
+                # We cannot avoid fetching all of the servers, if we are
+                # asked for another ordering than the hostnames.  We can
+                # still avoid materializing all of the attributes of all of
+                # them at once.
+                servers = _fetch_servers(
+                    *get_server_query(
+                        attribute_filters, related_vias, metadata
+                    )
+                )
+                servers = _get_servers_page(
+                    servers, materializer_args[1], None, 0, metadata
+                )
+                batches = iter([
+                    servers[i:(i + batch_size)]
+                    for i in range(0, len(servers), batch_size)
+                ])
+
+        while True:
+            with read_replica(alias):
+                servers = next(batches, None)
+                if servers is None:
+                    break
+                objects = list(QueryMaterializer(
+                    servers, *materializer_args, metadata=metadata
+                ))
+            yield objects
+
+
+def _stream_servers(
+    attribute_filters, related_vias, metadata, batch_size, order_by
+):
+    """Fetch the servers in batches using a server side cursor"""
+    sql_query, params = get_server_query(
+        attribute_filters, related_vias, metadata, order_by=order_by
+    )
+    intern_ip_field = Server._meta.get_field('intern_ip')
+
+    # Django doesn't support the server side cursors, so we need to use
+    # the underlying connection of it, and wrap its errors ourselves.
+    connection = get_read_connection()
+    connection.ensure_connection()
+    with connection.connection.cursor('stream_query') as cursor:
+        try:
+            with connection.wrap_database_errors:
+                cursor.execute(sql_query, params)
+        except DataError as error:
+            raise ValidationError(error)
+
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+
+            yield [
+                Server(
+                    server_id=server_id,
+                    hostname=hostname,
+                    intern_ip=intern_ip_field.to_python(intern_ip),
+                    servertype_id=servertype_id,
+                )
+                for server_id, hostname, intern_ip, servertype_id in rows
+            ]
+
+
+def _prepare_query(metadata, filters, restrict, order_by):
+    """Prepare the arguments for the filtering and the materialization"""
 
     # We need the restrict argument in slightly different structure.
     if restrict is None:
@@ -26,43 +337,9 @@ def execute_query(filters, restrict, order_by):
     # of the query.
     attribute_ids = set(_collect_attribute_ids(joins, filters, order_by))
 
-    # We can fetch the attributes altogether before starting the database
-    # transaction.  None on the restrict argument is special meaning
-    # materialize all possible attributes, so we query them all.  The database
-    # transaction doesn't have to be started yet, because the metadata like
-    # the attributes are mostly stable, and the data model wouldn't let us
-    # see anything in inconsistent state, even while it is being changed
-    # concurrently.  We start by the special attributes and fetch more
-    # if necessary.
-    attribute_lookup = dict(Attribute.specials)
-    if restrict is None:
-        _update_attribute_lookup(attribute_lookup)
-    elif any(a not in attribute_lookup for a in attribute_ids):
-        _update_attribute_lookup(attribute_lookup, attribute_ids)
+    attribute_lookup = metadata.attribute_lookup
     _check_attributes_exist(attribute_ids, attribute_lookup)
-
-    # If we have real attributes on the query filter, we can use them to
-    # get the possible servertypes.  This is necessary to eliminate
-    # not-desired objects.  We also use them to eliminate the servertype
-    # attribute relations passed to the SQL generator module in "related_vias".
-    # This is an optimization that matters, because all of those in
-    # "related_vias" hit the database as complicated sub-queries.
-    related_vias = {}
-    real_attribute_ids = [a for a in filters if a not in Attribute.specials]
-    if real_attribute_ids:
-        servertype_attributes = list(ServertypeAttribute.objects.filter(
-            attribute_id__in=real_attribute_ids
-        ))
-        servertype_ids = _get_possible_servertype_ids(servertype_attributes)
-        filters = dict(filters)
-        servertype_ids = _override_servertype_filter(filters, servertype_ids)
-        servertype_attributes = [
-            sa for sa in servertype_attributes
-            if sa.servertype_id in servertype_ids
-        ]
-        _update_related_vias(
-            related_vias, servertype_attributes, attribute_lookup
-        )
+    filters, related_vias = _get_related_vias(filters, metadata)
 
     # Here we prepare the join dictionary for the query materializer.
     # For None on the restrict argument, we just use the complete list of
@@ -80,25 +357,79 @@ def execute_query(filters, restrict, order_by):
     if order_by is not None:
         materializer_args.append([attribute_lookup[a] for a in order_by])
 
-    # REPEATABLE READ isolation level ensures Postgres to give us a consistent
-    # snapshot for the database transaction.  We also set READ ONLY as this
-    # is a query operation.  Perhaps this is also enabling some optimization
-    # on the Postgres side.
-    with transaction.atomic():
-        connection.cursor().execute(
-            'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY'
+    return filters, related_vias, materializer_args
+
+
+def _push_order_by(materializer_args, metadata):
+    """Move the ordering from the materializer to the database if possible
+
+    It returns the materializer arguments together with the ordering to
+    pass to the SQL generator, or None, if the ordering is left to
+    the materializer.
+    """
+    if len(materializer_args) == 1:
+        return materializer_args, None
+
+    sql_order_by = []
+    for attribute in materializer_args[1]:
+        if attribute.special:
+            sql_order_by.append((attribute, None))
+            continue
+
+        # The order of the multi attributes depends on all of their values.
+        # The other attributes are not stored on the servers themselves.
+        if (
+            attribute.multi or
+            attribute.type in ('supernet', 'domain', 'reverse')
+        ):
+            return materializer_args, None
+        servertype_attributes = (
+            metadata.attribute_servertype_attributes[attribute.attribute_id]
         )
+        if any(sa.related_via_attribute_id for sa in servertype_attributes):
+            return materializer_args, None
 
-        # The actual query execution procedure is 2 steps: first filtering
-        # the objects, and then materializing the requested attributes.
-        # The joined attributes and ordering are also handled on
-        # the materialization step.  Ordering has to be handled by it, because
-        # some properties of the attribute values which might be relevant
-        # for ordering may be lost after the materialization.  See the query
-        # materializer module for its details.  The functions on this module
-        # continues with the filtering step.
-        servers = _get_servers(filters, attribute_lookup, related_vias)
-        return list(QueryMaterializer(servers, *materializer_args))
+        sql_order_by.append(
+            (attribute, [sa.servertype_id for sa in servertype_attributes])
+        )
+
+    return materializer_args[:1], sql_order_by
+
+
+@read_replica()
+def count_query(filters):
+    """Count the objects matching with the filters"""
+
+    metadata = get_metadata()
+    attribute_lookup = metadata.attribute_lookup
+    _check_attributes_exist(filters, attribute_lookup)
+    filters, related_vias = _get_related_vias(filters, metadata)
+
+    return _count_servers(filters, metadata, related_vias)
+
+
+def _count_servers(filters, metadata, related_vias):
+    attribute_filters = _get_attribute_filters(
+        filters, metadata.attribute_lookup
+    )
+    if attribute_filters is None:
+        return 0
+
+    sql_query, params = get_server_count_query(
+        attribute_filters, related_vias, metadata
+    )
+    with get_read_connection().cursor() as cursor:
+        try:
+            cursor.execute(sql_query, params)
+        except DataError as error:
+            raise ValidationError(error)
+        return cursor.fetchone()[0]
+
+
+def _set_transaction_read_only():
+    get_read_connection().cursor().execute(
+        'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY'
+    )
 
 
 def _get_joins(restrict):
@@ -134,16 +465,6 @@ def _collect_attribute_ids(joins=None, filters=None, order_by=None):
             yield attribute_id
 
 
-def _update_attribute_lookup(attribute_lookup, attribute_ids=None):
-    if attribute_ids is None:
-        queryset = Attribute.objects.all()
-    else:
-        queryset = Attribute.objects.filter(attribute_id__in=attribute_ids)
-
-    for attribute in queryset:
-        attribute_lookup[attribute.attribute_id] = attribute
-
-
 def _check_attributes_exist(attribute_ids, attribute_lookup):
     """Check whether all required attribute ids are valid"""
 
@@ -152,7 +473,39 @@ def _check_attributes_exist(attribute_ids, attribute_lookup):
             raise ObjectDoesNotExist('No attribute "{}"'.format(attribute_id))
 
 
-def _get_possible_servertype_ids(servertype_attributes):
+def _get_related_vias(filters, metadata):
+    """Prepare the related_vias for the filters
+
+    If we have real attributes on the query filter, we can use them to
+    get the possible servertypes.  This is necessary to eliminate
+    not-desired objects.  We also use them to eliminate the servertype
+    attribute relations passed to the SQL generator module in "related_vias".
+    This is an optimization that matters, because all of those in
+    "related_vias" hit the database as complicated sub-queries.
+    """
+    related_vias = {}
+    real_attribute_ids = [a for a in filters if a not in Attribute.specials]
+    if real_attribute_ids:
+        servertype_attributes = metadata.get_servertype_attributes(
+            real_attribute_ids
+        )
+        servertype_ids = _get_possible_servertype_ids(
+            real_attribute_ids, servertype_attributes
+        )
+        filters = dict(filters)
+        servertype_ids = _override_servertype_filter(filters, servertype_ids)
+        servertype_attributes = [
+            sa for sa in servertype_attributes
+            if sa.servertype_id in servertype_ids
+        ]
+        _update_related_vias(
+            related_vias, servertype_attributes, metadata.attribute_lookup
+        )
+
+    return filters, related_vias
+
+
+def _get_possible_servertype_ids(attribute_ids, servertype_attributes):
     """Get the servertypes that can possible match with the query with
     the given attributes
 
@@ -163,10 +516,9 @@ def _get_possible_servertype_ids(servertype_attributes):
     """
 
     # First, we need to index the servertypes by the attributes.
-    attribute_servertype_ids = {}
+    attribute_servertype_ids = {a: set() for a in attribute_ids}
     for sa in servertype_attributes:
-        ids = attribute_servertype_ids.setdefault(sa.attribute_id, set())
-        ids.add(sa.servertype_id)
+        attribute_servertype_ids[sa.attribute_id].add(sa.servertype_id)
 
     # Then we get the servertype list of the first attribute, and continue
     # reducing it by getting intersection of the list of the next attribute.
@@ -200,19 +552,12 @@ def _update_related_vias(
     """Prepare the related_vias dictionary for the SQL generator module
 
     It is lists in dictionaries of dictionaries indexed first by attribute_id
-    and then by the related_via_attribute.  The attribute lookup dictionary
-    passed to here may not have all of the related via attributes we need.
-    In this case we recursively query them and repeat the process for
-    the remaining object.
+    and then by the related_via_attribute.
     """
-    to_be_looked_up = []
     for sa in servertype_attributes:
         related_via_attribute_id = sa.related_via_attribute_id
         if not related_via_attribute_id:
             related_via_attribute = None
-        elif related_via_attribute_id not in attribute_lookup:
-            to_be_looked_up.append(sa)
-            continue
         else:
             related_via_attribute = attribute_lookup[related_via_attribute_id]
 
@@ -223,41 +568,124 @@ def _update_related_vias(
             .append(sa.servertype_id)
         )
 
-    if to_be_looked_up:
-        _update_attribute_lookup(
-            attribute_lookup,
-            {sa.related_via_attribute_id for sa in to_be_looked_up},
-        )
-        _update_related_vias(related_vias, to_be_looked_up, attribute_lookup)
+
+def _get_servers(
+    filters,
+    metadata,
+    related_vias,
+    limit=None,
+    offset=0,
+    after=None,
+    order_by=None,
+):
+    """Evaluate the filters to fetch the matching servers
+
+    It returns the SQL query and its parameters together with the servers.
+    The query is None, if it is not executed at all.
+    """
+
+    attribute_filters = _get_attribute_filters(
+        filters, metadata.attribute_lookup
+    )
+    if attribute_filters is None:
+        return [], None
+
+    # If you managed to read this so far, the last step is refreshingly
+    # easy: get and execute the raw SQL query.
+    server_query = get_server_query(
+        attribute_filters, related_vias, metadata, limit, offset, after,
+        order_by,
+    )
+
+    return _fetch_servers(*server_query), server_query
 
 
-def _get_servers(filters, attribute_lookup, related_vias):
-    """Evaluate the filters to fetch the matching servers"""
+def _fetch_servers(sql_query, params):
+    try:
+        return list(Server.objects.raw(sql_query, params))
+    except DataError as error:
+        raise ValidationError(error)
+
+
+def _get_attribute_filters(filters, attribute_lookup):
+    """Get the filters to pass to the SQL generator module
+
+    It returns None, if the filters are destined to fail.
+    """
 
     # From now on, we will pass the filters dictionary using the attribute
     # objects as the keys.  The SQL generator module will repeatedly need
     # the properties of the attributes.
     attribute_filters = []
     for attribute_id, filt in filters.items():
+        attribute = attribute_lookup[attribute_id]
+        filt = optimize_filter(attribute, filt)
 
         # Before we actually execute the query, we can check the destiny of
         # the filters.  If one is destined to fail, we can just return empty
         # result.  If some are destined to pass, we can just remove them.
         # We could do this much earlier, even before preparing the attribute
         # lookup, but we don't because we still want to raise an error for
-        # nonexistent attributes.
+        # nonexistent attributes.  The optimizer can find out the destiny
+        # of the nested filters too.
         destiny = filt.destiny()
         if destiny is False:
-            return []
+            return None
         if destiny is True:
             continue
 
-        attribute_filters.append((attribute_lookup[attribute_id], filt))
+        attribute_filters.append((attribute, filt))
+
+    # The cheaper filters come first, so that the database can use them
+    # to avoid evaluating the others.
+    attribute_filters.sort(key=lambda f: get_filter_cost(f[1]))
+
+    return attribute_filters
+
+
+def _get_servers_page(servers, order_by_attributes, limit, offset, metadata):
+    """Get the servers on the requested page of the ordered result
+
+    We only materialize the attributes needed for ordering for all of
+    the servers.  The rest of them are going to be materialized only for
+    the servers on the page.
+    """
+    server_lookup = {s.server_id: s for s in servers}
+    objs = QueryMaterializer(
+        servers,
+        {a: None for a in order_by_attributes},
+        order_by_attributes,
+        metadata=metadata,
+    )
+    stop = None if limit is None else offset + limit
+
+    return [server_lookup[o.object_id] for o in islice(objs, offset, stop)]
+
+
+def _get_next_cursor(servers, order_by, limit):
+    """Get the cursor to continue after the given servers
+
+    The next page would be empty, if this one is not full.  We only return
+    a cursor, if there can be more.
+    """
+    if order_by is not None or not limit or len(servers) < limit:
+        return None
+
+    return urlsafe_b64encode(
+        json.dumps([servers[-1].hostname]).encode()
+    ).decode()
+
+
+def _decode_cursor(cursor, order_by):
+    """Get the hostname to continue after from the cursor"""
+    if order_by is not None:
+        raise ValidationError('Cursor cannot be used together with ordering')
 
-    # If you managed to read this so far, the last step is refreshingly
-    # easy: get and execute the raw SQL query.
-    sql_query = get_server_query(attribute_filters, related_vias)
     try:
-        return list(Server.objects.raw(sql_query))
-    except DataError as error:
-        raise ValidationError(error)
+        hostname, = json.loads(urlsafe_b64decode(cursor.encode()).decode())
+    except (AttributeError, TypeError, ValueError):
+        hostname = None
+    if not isinstance(hostname, str):
+        raise ValidationError('Invalid cursor')
+
+    return hostname
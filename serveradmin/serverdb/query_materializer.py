@@ -9,31 +9,62 @@ Copyright (c) 2019 InnoGames GmbH
 
 from ipaddress import IPv4Address, IPv6Address
 
+from django.db import connection
+
 from adminapi.dataset import DatasetObject
-from serveradmin.serverdb.models import (
-    Servertype,
-    Attribute,
-    ServertypeAttribute,
-    Server,
-    ServerAttribute,
-    ServerRelationAttribute,
-)
+from serveradmin.serverdb.metadata import get_metadata
+from serveradmin.serverdb.models import Attribute, Server, ServerAttribute
+from serveradmin.serverdb.routers import get_read_connection
+
+_SERVER_COLUMNS = [
+    ('server.server_id', 'integer'),
+    ('server.hostname', 'text'),
+    ('server.intern_ip', 'inet'),
+    ('server.servertype_id', 'text'),
+]
 
 
 class QueryMaterializer:
-    def __init__(self, servers, joined_attributes, order_by_attributes=[]):
+    """Materialize the attributes of the given servers
+
+    The attribute values are fetched from the database by joining
+    the attribute tables with the servers.  The "server_query" argument can
+    be passed as the SQL query and its parameters to filter exactly the given
+    servers.  It is used on the joins instead of sending the identifiers of
+    all of the servers back to the database.
+
+    The "related_depth" and "context" arguments are only used internally
+    by the nested materializers.  The context is the list of the attributes
+    of the servers materialized by the outer ones.  We don't fetch the servers
+    again, if we find all of the attributes we need in there.
+    """
+
+    def __init__(
+        self, servers, joined_attributes, order_by_attributes=[],
+        metadata=None, server_query=None, related_depth=0, context=[],
+    ):
         self._servers = servers
+        self._server_query = server_query
+        self._related_depth = related_depth
+        self._context = context
         self._joined_attributes = joined_attributes
         self._order_by_attributes = order_by_attributes
-        # XXX: Optimize this query out
-        self._servertype_lookup = {
-            servertype.servertype_id: servertype
-            for servertype in Servertype.objects.all()
-        }
+        if metadata is None:
+            metadata = get_metadata()
+        self._metadata = metadata
 
+        self._server_lookup = {}
         self._server_attributes = {}
+        self._fetched_servers = []
         servers_by_type = {}
         for server in self._servers:
+            known_attributes = self._get_known_attributes(server)
+            if known_attributes is not None:
+                self._server_attributes[server] = known_attributes
+                continue
+
+            self._server_lookup[server.server_id] = server
+            self._fetched_servers.append(server)
             self._server_attributes[server] = {
                 Attribute.specials['object_id']: server.server_id,
                 Attribute.specials['hostname']: server.hostname,
@@ -64,44 +95,63 @@ class QueryMaterializer:
             for s in servers
         )
 
+    def _get_known_attributes(self, server):
+        """Find the attributes of the server in the context"""
+        servertype_attributes = (
+            self._metadata.servertype_attributes[server.servertype_id]
+        )
+        for server_attributes in self._context:
+            known_attributes = server_attributes.get(server)
+            if known_attributes is not None and all(
+                a in known_attributes
+                for a in self._joined_attributes
+                if a.attribute_id in servertype_attributes or a.special
+            ):
+                return known_attributes
+
+        return None
+
     def _select_attributes(self, servertype_ids):
         self._attributes_by_type = {}
         self._servertype_ids_by_attribute = {}
         self._related_servertype_attributes = []
-        attributes = {
-            a.attribute_id: a for a in self._joined_attributes
-        }
-        for sa in ServertypeAttribute.objects.filter(
-            servertype_id__in=servertype_ids,
-            attribute__in=self._joined_attributes,
-        ):
-            attribute = attributes[sa.attribute_id]
-            self._select_servertype_attribute(attribute, sa)
+        for servertype_id in servertype_ids:
+            servertype_attributes = (
+                self._metadata.servertype_attributes[servertype_id]
+            )
+            for attribute in self._joined_attributes:
+                sa = servertype_attributes.get(attribute.attribute_id)
+                if sa is not None:
+                    self._select_servertype_attribute(attribute, sa)
 
     def _select_servertype_attribute(self, attribute, sa):
+        servertype_ids = self._servertype_ids_by_attribute.setdefault(
+            attribute, []
+        )
+        if sa.servertype_id in servertype_ids:
+            return
+        servertype_ids.append(sa.servertype_id)
         self._attributes_by_type.setdefault(attribute.type, set()).add(
             attribute
         )
-        self._servertype_ids_by_attribute.setdefault(attribute, []).append(
-            sa.servertype_id
-        )
 
-        related_via_attribute_id = sa.related_via_attribute_id
-        if related_via_attribute_id:
-            # TODO: Order the list in a way to support recursive related
-            # attributes.
+        # The related attributes can be related via each other in a circle
+        # on the metadata.  The chains without a circle cannot be longer than
+        # the number of the related attributes, so we stop following them
+        # at that point.  The value stays uninitialized in this case.
+        if (
+            sa.related_via_attribute_id and
+            self._related_depth < self._metadata.related_attribute_count
+        ):
             self._related_servertype_attributes.append((attribute, sa))
 
             # If we have related attributes in the attribute list, we have
             # to add the relations in there, too.  We are going to use
             # those to query the related attributes.
-            # TODO: Optimize this to avoid recursion and selecting related
-            # attribute in here
-            sa = ServertypeAttribute.objects.filter(
-                servertype_id=sa.servertype_id,
-                attribute_id=related_via_attribute_id,
-            ).select_related('attribute').get()
-            self._select_servertype_attribute(sa.attribute, sa)
+            via_sa = self._metadata.servertype_attributes[sa.servertype_id][
+                sa.related_via_attribute_id
+            ]
+            self._select_servertype_attribute(via_sa.attribute, via_sa)
 
     def _initialize_attributes(self, servers_by_type):
         for attribute, servertype_ids in (
@@ -114,6 +164,7 @@ class QueryMaterializer:
 
     def _add_attributes(self, servers_by_type):
         """Add the attributes to the results"""
+        attribute_lookups = {}
         for key, attributes in self._attributes_by_type.items():
             if key == 'supernet':
                 for attribute in attributes:
@@ -130,36 +181,169 @@ class QueryMaterializer:
                         for s in servers_by_type[st]
                     ])
             elif key == 'reverse':
-                reversed_attributes = {
+                attribute_lookups[key] = {
                     a.reversed_attribute_id: a for a in attributes
                 }
-                for sa in ServerRelationAttribute.objects.filter(
-                    value_id__in=self._server_attributes.keys(),
-                    attribute_id__in=reversed_attributes.keys(),
-                ).select_related('server'):
-                    self._add_attribute_value(
-                        sa.value,
-                        reversed_attributes[sa.attribute_id],
-                        sa.server,
-                    )
             else:
-                attribute_lookup = {a.attribute_id: a for a in attributes}
-                for sa in ServerAttribute.get_model(key).objects.filter(
-                    server__in=self._server_attributes.keys(),
-                    attribute__in=attributes,
-                ).select_related('server'):
-                    self._add_attribute_value(
-                        sa.server,
-                        attribute_lookup[sa.attribute_id],
-                        sa.get_value(),
-                    )
+                attribute_lookups[key] = {
+                    a.attribute_id: a for a in attributes
+                }
+
+        if attribute_lookups:
+            self._add_attribute_values(attribute_lookups)
+
+    def _add_attribute_values(self, attribute_lookups):
+        """Select the values of all of the attribute types at once
+
+        We select the values from all of the tables in a single UNION ALL
+        query.  The tables have different types of values, so every one of
+        them gets its own columns on the result.  They are NULL on the rows
+        of the other tables.  The first column tells which table the row is
+        coming from.
+        """
+        keys = sorted(attribute_lookups)
+        columns = [_get_value_columns(k) for k in keys]
+        converters = [_get_value_converter(k) for k in keys]
+        offsets = []
+        offset = 3
+        for key_columns in columns:
+            offsets.append(offset)
+            offset += len(key_columns)
+
+        selects = []
+        params = {}
+        for index, key in enumerate(keys):
+            param = 'attribute_ids_{}'.format(index)
+            params[param] = list(attribute_lookups[key])
+            selects.append(_get_value_select(index, key, param, [
+                e if i == index else 'NULL::' + t
+                for i, key_columns in enumerate(columns)
+                for e, t in key_columns
+            ]))
+
+        for row in self._execute(' UNION ALL '.join(selects), params):
+            index = row[0]
+            start = offsets[index]
+            self._add_attribute_value(
+                self._server_lookup[row[1]],
+                attribute_lookups[keys[index]][row[2]],
+                converters[index](*row[start:(start + len(columns[index]))]),
+            )
+
+    def _get_matched_query(self):
+        """Get the SQL query selecting the identifiers of the servers"""
+        # The query would also select the servers we have got from
+        # the context.
+        if self._server_query is not None and not self._context:
+            sql, params = self._server_query
+            return 'SELECT server_id FROM ({}) AS filtered'.format(sql), params
+
+        # We pass the identifiers as a single array, so that Postgres can
+        # treat them as a relation to join with.
+        return 'SELECT unnest(%(server_ids)s::integer[]) AS server_id', {
+            'server_ids': [s.server_id for s in self._fetched_servers],
+        }
+
+    def _execute(self, sql, params):
+        matched_sql, matched_params = self._get_matched_query()
+        with get_read_connection().cursor() as cursor:
+            cursor.execute(
+                'WITH matched AS ({}) {}'.format(matched_sql, sql),
+                dict(matched_params, **params),
+            )
+            return cursor.fetchall()
 
     def _add_related_attributes(self, servers_by_type):
+        """Add the attributes of the related servers
+
+        The related attributes can be related via other related attributes
+        of the same servers.  We add them in the order of their dependencies
+        on each other.  All of the related attributes on the same step are
+        materialized together for all of the related servers.  The related
+        servers may get their values from other servers in the same way.
+        """
+        steps = {}
         for attribute, sa in self._related_servertype_attributes:
-            self._add_related_attribute(attribute, sa, servers_by_type)
+            steps.setdefault(self._get_related_step(sa), []).append(
+                (attribute, sa)
+            )
+        for step in sorted(steps):
+            self._add_related_attributes_step(steps[step], servers_by_type)
+
+    def _get_related_step(self, sa):
+        """Count the related attributes the given one depends on"""
+        step = 0
+        seen = {sa}
+        while True:
+            sa = self._metadata.servertype_attributes[sa.servertype_id][
+                sa.related_via_attribute_id
+            ]
+            if not sa.related_via_attribute_id or sa in seen:
+                return step
+            seen.add(sa)
+            step += 1
+
+    def _add_related_attributes_step(self, related, servers_by_type):
+        servers_by_related_list = []
+        related_servers = set()
+        for attribute, sa in related:
+            servers_by_related = self._get_servers_by_related(
+                sa, servers_by_type
+            )
+            servers_by_related_list.append(servers_by_related)
+            related_servers.update(servers_by_related.keys())
+
+        related_materializer = type(self)(
+            list(related_servers),
+            {attribute: None for attribute, sa in related},
+            metadata=self._metadata,
+            related_depth=self._related_depth + 1,
+            context=self._context,
+        )
+        related_attributes = related_materializer._server_attributes
+
+        for (attribute, sa), servers_by_related in zip(
+            related, servers_by_related_list
+        ):
+            for source, targets in servers_by_related.items():
+                value = related_attributes[source].get(attribute)
+                if value is None:
+                    continue
+                for target in targets:
+                    if attribute.multi:
+                        self._server_attributes[target][attribute].update(
+                            value
+                        )
+                    else:
+                        self._server_attributes[target][attribute] = value
+
+    def _get_servers_by_related(self, sa, servers_by_type):
+        """Index the servers by the servers they are related to"""
+        related_via_attribute = sa.related_via_attribute
+        servers_by_related = {}
+        for target in servers_by_type[sa.servertype_id]:
+            attributes = self._server_attributes[target]
+            if related_via_attribute not in attributes:
+                continue
+            if related_via_attribute.multi:
+                sources = attributes[related_via_attribute]
+            elif attributes[related_via_attribute] is None:
+                continue
+            else:
+                sources = [attributes[related_via_attribute]]
+            for source in sources:
+                servers_by_related.setdefault(source, []).append(target)
+
+        return servers_by_related
 
     def _add_domain_attribute(self, attribute, servers):
-        domain_names = {s.hostname.split('.', 1)[-1] for s in servers}
+        """Look up the domains of the servers by their hostnames
+
+        The domain is the part of the hostname after the first dot.  It
+        has to match the expression the SQL generator uses for filtering.
+        """
+        domain_names = {_get_domain_name(s.hostname) for s in servers}
+        domain_names.discard(None)
         domain_lookup = {
             domain.hostname: domain
             for domain in Server.objects.filter(
@@ -170,60 +354,66 @@ class QueryMaterializer:
 
         for server in servers:
             self._server_attributes[server][attribute] = domain_lookup.get(
-                server.hostname.split('.', 1)[-1]
+                _get_domain_name(server.hostname)
             )
 
     def _add_supernet_attribute(self, attribute, servers):
         """Merge-join networks to the servers
 
-        This function takes advantage of networks in the same servertype not
-        overlapping with each other.
+        We select all of the networks containing any of the servers in
+        a single query, and join them in memory.  This function takes
+        advantage of networks in the same servertype not overlapping with
+        each other.
         """
-        target = None
-        for source in sorted(servers, key=lambda s: _sort_key(s.intern_ip)):
-            # Check the previous target
-            if target is not None:
-                network = target.intern_ip.network
-                if network.version != source.intern_ip.version:
-                    target = None
-                elif network.broadcast_address < source.intern_ip.ip:
-                    target = None
-                elif source.intern_ip not in network:
-                    continue
-            # Check for a new target
-            if target is None:
-                try:
-                    target = source.get_supernet(attribute.target_servertype)
-                except Server.DoesNotExist:
-                    continue
-            self._server_attributes[source][attribute] = target
-
-    def _add_related_attribute(
-        self, attribute, servertype_attribute, servers_by_type
-    ):
-        related_via_attribute = servertype_attribute.related_via_attribute
-
-        # First, index the related servers for fast access later
-        servers_by_related = {}
-        for target in servers_by_type[servertype_attribute.servertype_id]:
-            attributes = self._server_attributes[target]
-            if related_via_attribute in attributes:
-                if related_via_attribute.multi:
-                    for source in attributes[related_via_attribute]:
-                        servers_by_related.setdefault(source, []).append(
-                            target
-                        )
-                else:
-                    source = attributes[related_via_attribute]
-                    servers_by_related.setdefault(source, []).append(target)
+        targets = sorted(
+            self._select_supernets(attribute),
+            key=lambda s: _network_sort_key(s.intern_ip.network),
+        )
+        index = 0
+        for source in sorted(
+            (s for s in servers if s.intern_ip is not None),
+            key=lambda s: _network_sort_key(s.intern_ip.network),
+        ):
+            network = source.intern_ip.network
+
+            # Skip the targets which are ending before this server
+            while index < len(targets) and (
+                _network_sort_key(targets[index].intern_ip.network, True) <
+                _network_sort_key(network)
+            ):
+                index += 1
+            if index == len(targets):
+                break
+
+            target = targets[index]
+            supernet = target.intern_ip.network
+            if (
+                supernet.version == network.version and
+                supernet.network_address <= network.network_address and
+                supernet.broadcast_address >= network.broadcast_address
+            ):
+                self._server_attributes[source][attribute] = target
+
+    def _select_supernets(self, attribute):
+        rows = self._execute(
+            'SELECT DISTINCT'
+            '   supernet.server_id,'
+            '   supernet.hostname,'
+            '   supernet.intern_ip,'
+            '   supernet.servertype_id '
+            'FROM matched '
+            'JOIN server USING (server_id) '
+            'JOIN server AS supernet '
+            '   ON supernet.intern_ip >>= server.intern_ip '
+            'WHERE server.servertype_id = ANY(%(servertype_ids)s) AND '
+            '   supernet.servertype_id = %(target_servertype_id)s',
+            {
+                'servertype_ids': self._servertype_ids_by_attribute[attribute],
+                'target_servertype_id': attribute.target_servertype_id,
+            },
+        )
 
-        # Then, query and set the related attributes
-        for sa in ServerAttribute.get_model(attribute.type).objects.filter(
-            server__hostname__in=servers_by_related.keys(),
-            attribute=attribute,
-        ).select_related('server'):
-            for target in servers_by_related[sa.server]:
-                self._add_attribute_value(target, attribute, sa.get_value())
+        return [_get_server(*row) for row in rows]
 
     def _add_attribute_value(self, server, attribute, value):
         if attribute.multi:
@@ -256,7 +446,7 @@ class QueryMaterializer:
         return 0, _sort_key(value)
 
     def _get_attributes(self, server, join_results):   # NOQA: C901
-        servertype = self._servertype_lookup[server.servertype_id]
+        servertype = self._metadata.servertypes[server.servertype_id]
         server_attributes = self._server_attributes[server]
         for attribute, value in server_attributes.items():
             if attribute not in self._joined_attributes:
@@ -293,14 +483,56 @@ class QueryMaterializer:
                 yield attribute.attribute_id, value
 
     def _get_join_results(self):
-        results = dict()
-        for attribute, joined_attributes in self._joined_attributes.items():
-            if joined_attributes is None:
-                continue
+        """Materialize the joined servers
+
+        We materialize the servers of all of the joined attributes together
+        with the union of their joined attributes.  The objects are then
+        restricted to the attributes joined by each one of them.  The nested
+        joins are handled the same way, so we need a constant number of
+        queries for every level of the joins.
+        """
+        joins = {
+            attribute: joined_attributes
+            for attribute, joined_attributes in self._joined_attributes.items()
+            if joined_attributes is not None
+        }
+        if not joins:
+            return {}
+
+        servers_by_attribute = {
+            attribute: self._get_servers_to_join(attribute)
+            for attribute in joins
+        }
+        if len(joins) == 1:
+            merged_attributes = next(iter(joins.values()))
+        else:
+            merged_attributes = {}
+            for joined_attributes in joins.values():
+                _merge_joined_attributes(merged_attributes, joined_attributes)
+
+        servers = set().union(*servers_by_attribute.values())
+        objects = {
+            o.object_id: o
+            for o in type(self)(
+                list(servers),
+                merged_attributes,
+                metadata=self._metadata,
+                context=[self._server_attributes] + self._context,
+            )
+        }
 
-            servers = self._get_servers_to_join(attribute)
-            server_objs = type(self)(servers, joined_attributes)
-            results[attribute] = dict(zip(servers, server_objs))
+        results = dict()
+        for attribute, joined_attributes in joins.items():
+            results[attribute] = {
+                s: (
+                    objects[s.server_id]
+                    if joined_attributes is merged_attributes
+                    else _restrict_object(
+                        objects[s.server_id], joined_attributes
+                    )
+                )
+                for s in servers_by_attribute[attribute]
+            }
 
         return results
 
@@ -321,6 +553,140 @@ class QueryMaterializer:
         return servers
 
 
+def _merge_joined_attributes(merged_attributes, joined_attributes):
+    """Merge the joined attributes into the first argument recursively
+
+    If an attribute is joined only by some of them, we add the hostname to
+    its joined attributes, so that we can get it back for the others.
+    """
+    hostname_attribute = Attribute.specials['hostname']
+    for attribute, nested_attributes in joined_attributes.items():
+        if attribute not in merged_attributes:
+            if nested_attributes is not None:
+                nested_attributes = _merge_joined_attributes(
+                    {}, nested_attributes
+                )
+            merged_attributes[attribute] = nested_attributes
+        elif nested_attributes is None:
+            if merged_attributes[attribute] is not None:
+                merged_attributes[attribute].setdefault(
+                    hostname_attribute, None
+                )
+        else:
+            if merged_attributes[attribute] is None:
+                merged_attributes[attribute] = {hostname_attribute: None}
+            _merge_joined_attributes(
+                merged_attributes[attribute], nested_attributes
+            )
+
+    return merged_attributes
+
+
+def _restrict_object(obj, joined_attributes):
+    """Restrict the materialized object to the joined attributes"""
+    joined_attributes = {
+        a.attribute_id: j for a, j in joined_attributes.items()
+    }
+    return DatasetObject(
+        (
+            (k, _restrict_value(v, joined_attributes[k]))
+            for k, v in obj.items()
+            if k in joined_attributes
+        ),
+        obj.object_id,
+    )
+
+
+def _restrict_value(value, joined_attributes):
+    if isinstance(value, (set, frozenset)):
+        return [_restrict_value(v, joined_attributes) for v in value]
+    if not isinstance(value, DatasetObject):
+        return value
+    if joined_attributes is None:
+        return value['hostname']
+    return _restrict_object(value, joined_attributes)
+
+
+def _get_server(server_id, hostname, intern_ip, servertype_id):
+    return Server(
+        server_id=server_id,
+        hostname=hostname,
+        intern_ip=Server._meta.get_field('intern_ip').to_python(intern_ip),
+        servertype_id=servertype_id,
+    )
+
+
+def _get_value_select(index, attribute_type, param, value_columns):
+    """Get the SQL query to select the values of the attributes of a type
+
+    The relations are selected together with the servers on the other side
+    of them.
+    """
+    if attribute_type == 'reverse':
+        table = 'server_relation_attribute'
+        own_column, other_column = 'value', 'server_id'
+    else:
+        table = ServerAttribute.get_model(attribute_type)._meta.db_table
+        own_column, other_column = 'server_id', 'value'
+
+    columns = [str(index), 'attr.' + own_column, 'attr.attribute_id']
+    sql = (
+        'SELECT {} '
+        'FROM {} AS attr '
+        'JOIN matched ON matched.server_id = attr.{} '
+        .format(', '.join(columns + value_columns), table, own_column)
+    )
+    if attribute_type in ('relation', 'reverse'):
+        sql += 'JOIN server ON server.server_id = attr.{} '.format(
+            other_column
+        )
+    sql += 'WHERE attr.attribute_id = ANY(%({})s)'.format(param)
+
+    return sql
+
+
+def _get_value_columns(attribute_type):
+    """Get the SQL expressions and their types to select the values"""
+    if attribute_type == 'boolean':
+        return []
+    if attribute_type in ('relation', 'reverse'):
+        return _SERVER_COLUMNS
+    field = ServerAttribute.get_model(attribute_type)._meta.get_field('value')
+    return [('attr.value', field.db_type(connection))]
+
+
+def _get_value_converter(attribute_type):
+    """Get the function to convert the values selected from the database
+
+    The values need to be the same as the ones the models would return.
+    """
+    if attribute_type == 'boolean':
+        return lambda: True
+    if attribute_type in ('relation', 'reverse'):
+        return _get_server
+    if attribute_type == 'number':
+        return lambda value: int(value) if value.is_integer() else value
+    if attribute_type in ('inet', 'macaddr'):
+        model = ServerAttribute.get_model(attribute_type)
+        return model._meta.get_field('value').to_python
+    return lambda value: value
+
+
+def _network_sort_key(network, last=False):
+    """Sort the networks by their first or last addresses"""
+    if last:
+        return network.version, network.broadcast_address
+    return network.version, network.network_address
+
+
+def _get_domain_name(hostname):
+    """Get the part of the hostname after the first dot, or None"""
+    index = hostname.find('.')
+    if index < 1:
+        return None
+    return hostname[index + 1:]
+
+
 def _sort_key(value):
     if isinstance(value, (IPv4Address, IPv6Address)):
         return value.version, value
@@ -329,8 +695,10 @@ def _sort_key(value):
     return value
 
 
-def get_default_attribute_values(servertype_id):
-    servertype = Servertype.objects.get(servertype_id=servertype_id)
+def get_default_attribute_values(servertype_id, metadata=None):
+    if metadata is None:
+        metadata = get_metadata()
+    servertype = metadata.get_servertype(servertype_id)
     attribute_values = {}
 
     for attribute_id in Attribute.specials:
@@ -340,7 +708,7 @@ def get_default_attribute_values(servertype_id):
             value = None
         attribute_values[attribute_id] = value
 
-    for sa in servertype.attributes.all():
+    for sa in metadata.servertype_attributes[servertype.pk].values():
         attribute_values[sa.attribute_id] = sa.get_default_value()
 
     return attribute_values
@@ -0,0 +1,130 @@
+"""Serveradmin - Database Routers
+
+Copyright (c) 2019 InnoGames GmbH
+"""
+# The queries don't change anything, so they can run on the replicas of
+# the database to take the load off from the default one which takes
+# the commits.  The replicas are listed on the REPLICA_DATABASES setting.
+# The code to run on them needs to be wrapped with read_replica().  One of
+# the replicas is chosen when entering it, and all reads within it go to
+# that one: the ones through the ORM by the router, and the raw ones
+# through get_read_connection().  Everything else goes to the default
+# database as usual.  The reads always go to the default database while
+# a transaction is open on it, because it may have changes which are not
+# committed yet, even within read_replica().
+#
+# The replicas are behind the default database for a short while after
+# every commit.  With the REPLICA_READ_YOUR_WRITES setting, the process
+# remembers the version of the data it has written (see invalidate_data()
+# on the models) and keeps using the default database until the chosen
+# replica reaches it.  The version is bumped within the same transaction
+# as the changes, so the replica has the changes when it has the version.
+
+from contextlib import ContextDecorator
+from random import choice
+from threading import local
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+_local = local()
+_written_data_version = 0
+
+
+class ReplicaRouter(object):
+    """Route the reads within read_replica() to the chosen replica"""
+
+    def db_for_read(self, model, **hints):
+        return get_read_alias()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas have the same objects as the default database.
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db not in settings.REPLICA_DATABASES
+
+
+class read_replica(ContextDecorator):
+    """Context manager and decorator to run the reads on a replica
+
+    The alias of the database can be given to use the same one as
+    a previous block.  Otherwise, it is chosen when entering the block.
+    It can be nested, in which case the inner blocks keep using the same
+    database as the outer one.
+    """
+
+    def __init__(self, alias=None):
+        self._alias = alias
+
+    def __enter__(self):
+        alias = self._alias
+        if alias is None:
+            alias = choose_read_alias()
+        _get_aliases().append(alias)
+
+        return alias
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _get_aliases().pop()
+
+
+def choose_read_alias():
+    """Choose the database for a new read_replica() block
+
+    The inner blocks keep using the database of the outer one.
+    """
+    if _get_aliases():
+        return get_read_alias()
+    if (
+        not settings.REPLICA_DATABASES or
+        connections[DEFAULT_DB_ALIAS].in_atomic_block
+    ):
+        return DEFAULT_DB_ALIAS
+
+    alias = choice(settings.REPLICA_DATABASES)
+    if (
+        settings.REPLICA_READ_YOUR_WRITES and
+        _written_data_version and
+        _get_data_version(alias) < _written_data_version
+    ):
+        return DEFAULT_DB_ALIAS
+
+    return alias
+
+
+def get_read_alias():
+    """Get the alias of the database to read from"""
+    aliases = _get_aliases()
+    if not aliases or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return DEFAULT_DB_ALIAS
+    return aliases[-1]
+
+
+def get_read_connection():
+    """Get the connection of the database to read from"""
+    return connections[get_read_alias()]
+
+
+def remember_data_version(version):
+    """Remember the version of the data written by this process"""
+    global _written_data_version
+
+    _written_data_version = max(_written_data_version, version)
+
+
+def _get_aliases():
+    try:
+        return _local.aliases
+    except AttributeError:
+        aliases = _local.aliases = []
+        return aliases
+
+
+def _get_data_version(alias):
+    with connections[alias].cursor() as cursor:
+        cursor.execute('SELECT version FROM data_version')
+        return cursor.fetchone()[0]
@@ -2,8 +2,18 @@
 
 Copyright (c) 2019 InnoGames GmbH
 """
-# XXX: It is terrible to generate SQL this way.  We should make this use
-# parameterized queries at least.
+# The values of the filters are never put into the generated SQL.  They are
+# passed to the database as parameters instead.  This makes it possible to
+# reuse the generated SQL for the queries of the same shape, i.e. the same
+# attributes with the same filters, but with different values.  We keep
+# a cache of the generated SQL conditions indexed by the shape of the query.
+#
+# The exact values of the Any() filters are passed together as a single
+# array parameter.  Scripts often query thousands of servers by their
+# hostnames at once.  The SQL stays the same regardless of the number of
+# the values, so the database doesn't need to parse and plan a new huge
+# query every time.
+#
 # XXX: The code in this module is almost randomly split into functions.  Do
 # not try to guess what they would do.
 
@@ -26,17 +36,55 @@ from adminapi.filters import (
     StartsWith,
     Not,
 )
+from serveradmin.common.utils import LRUCache
 from serveradmin.serverdb.models import (
     Server,
     ServerAttribute,
     ServerRelationAttribute,
 )
 
+_condition_cache = LRUCache(1024)
+
+# The SQL types to cast the array parameters to.  The values of the types
+# which are not listed in here are compared as text.
+_SQL_TYPES = {
+    'number': 'double precision',
+    'inet': 'inet',
+    'macaddr': 'macaddr',
+    'date': 'date',
+    'datetime': 'timestamp with time zone',
+}
+
 
 # XXX: The "related_vias" argument is carried all the way through most of
 # the functions to optimize related_via_attribute selection.  We should find
 # a nicer way to achieve this.
-def get_server_query(attribute_filters, related_vias):
+def get_server_query(
+    attribute_filters,
+    related_vias,
+    metadata,
+    limit=None,
+    offset=0,
+    after=None,
+    order_by=None,
+):
+    """Get the SQL query and its parameters to filter the servers
+
+    The servers are ordered by their hostnames, unless the "order_by"
+    argument is given as a list of attributes together with the servertype
+    ids which have them.  Only the special and the single valued attributes
+    of the servers themselves can be used to order.  The hostnames are
+    still used to order the servers with the same values.  The "after"
+    argument can be used to get the servers after the given hostname.
+    """
+    condition, params = _get_condition(
+        attribute_filters, related_vias, metadata
+    )
+    if after is not None:
+        if condition:
+            condition += ' AND '
+        condition += 'server.hostname > %(after)s'
+        params['after'] = after
     sql = (
         'SELECT'
         ' server.server_id,'
@@ -45,24 +93,98 @@ def get_server_query(attribute_filters, related_vias):
         ' server.servertype_id'
         ' FROM server'
     )
-    if attribute_filters:
-        sql += ' WHERE ' + ' AND '.join(
-            _get_sql_condition(a, f, related_vias)
+    if condition:
+        sql += ' WHERE ' + condition
+    sql += ' ORDER BY '
+    if order_by:
+        sql += ', '.join(
+            e for a, s in order_by for e in _order_by_sql_expressions(a, s)
+        ) + ', '
+    sql += 'server.hostname'
+    if limit is not None:
+        sql += ' LIMIT %(limit)s'
+        params['limit'] = limit
+    if offset:
+        sql += ' OFFSET %(offset)s'
+        params['offset'] = offset
+
+    return sql, params
+
+
+def get_server_count_query(attribute_filters, related_vias, metadata):
+    """Get the SQL query and its parameters to count the servers"""
+    condition, params = _get_condition(
+        attribute_filters, related_vias, metadata
+    )
+    sql = 'SELECT count(*) FROM server'
+    if condition:
+        sql += ' WHERE ' + condition
+
+    return sql, params
+
+
+def _get_condition(attribute_filters, related_vias, metadata):
+    """Get the SQL condition and its parameters to filter the servers
+
+    We first walk through the filters to collect the parameters.  The walk
+    also gives us the key for the shape of the query.  We only need to
+    generate the SQL, if we haven't seen a query of the same shape recently.
+    The related attributes are followed through the metadata, so the SQL
+    also depends on its version.
+    """
+    slots = {}
+    params = {}
+    key = (metadata.version, ) + tuple(
+        (
+            _get_attribute_key(attribute),
+            _get_filter_key(attribute, filt, slots, params),
+            _get_related_vias_key(attribute, related_vias),
+        )
+        for attribute, filt in attribute_filters
+    )
+
+    condition = _condition_cache.get(key)
+    if condition is None:
+        condition = ' AND '.join(
+            _get_sql_condition(a, f, related_vias, metadata, slots)
             for a, f in attribute_filters
         )
-    sql += ' ORDER BY server.hostname'
+        _condition_cache.set(key, condition)
 
-    return sql
+    return condition, params
 
 
-def _get_sql_condition(attribute, filt, related_vias):
-    assert isinstance(filt, BaseFilter)
+def _get_attribute_key(attribute):
+    """Get the properties of the attribute the generated SQL depends on"""
+    return (
+        attribute.attribute_id,
+        attribute.type,
+        attribute.special.field if attribute.special else None,
+        attribute.target_servertype_id,
+        attribute.reversed_attribute_id,
+    )
 
-    if isinstance(filt, (Not, Any)):
-        return _logical_filter_sql_condition(attribute, filt, related_vias)
 
-    negate = False
-    template = ''
+def _get_filter_key(attribute, filt, slots, params):
+    """Get the shape of the filter, and collect its parameters
+
+    The parameters are named by the order we see the filters.  We remember
+    the names in the "slots" dictionary indexed by the filter objects for
+    the SQL generation.
+    """
+    if isinstance(filt, Not):
+        return (Not, _get_filter_key(attribute, filt.value, slots, params))
+
+    if isinstance(filt, Any):
+        simple_values, other_values = _split_simple_values(attribute, filt)
+        key = tuple(
+            _get_filter_key(attribute, v, slots, params) for v in other_values
+        )
+        if simple_values:
+            key += ((BaseFilter, _get_slot(
+                filt, slots, params, [str(v.value) for v in simple_values]
+            )), )
+        return (type(filt), key)
 
     if attribute.type == 'boolean':
         # We have already dealt with the logical filters.  Other
@@ -72,29 +194,130 @@ def _get_sql_condition(attribute, filt, related_vias):
                 'Boolean attribute "{}" cannot be used with {}() filter'
                 .format(attribute, type(filt).__name__)
             )
+        return (BaseFilter, _is_false(filt.value))
+
+    if isinstance(filt, Empty):
+        return (Empty, )
+
+    slot = _get_slot(filt, slots, params, _get_param_value(attribute, filt))
+
+    if isinstance(filt, Comparison):
+        return (Comparison, filt.comparator, slot)
+
+    return (type(filt), slot)
+
+
+def _get_slot(filt, slots, params, value):
+    slot = slots.get(id(filt))
+    if slot is None:
+        slot = slots[id(filt)] = 'v{}'.format(len(slots))
+        params[slot] = value
+
+    return slot
+
+
+def _get_param_value(attribute, filt):
+    """Get the value of the filter to pass to the database
+
+    The patterns for LIKE are prepared in here instead of concatenating
+    them on the SQL, so that the planner can see the constant prefixes
+    to use the indexes.  The special characters of LIKE are escaped to
+    match them literally.
+    """
+    value = str(filt.value)
+    if attribute.type != 'string' or not isinstance(filt, Contains):
+        return value
+
+    value = (
+        value
+        .replace('\\', '\\\\')
+        .replace('%', '\\%')
+        .replace('_', '\\_')
+    ) + '%'
+    if not isinstance(filt, StartsWith):
+        value = '%' + value
+
+    return value
+
+
+def _split_simple_values(attribute, filt):
+    """Split the exact values of Any() from the other filters
+
+    The exact values are matched all together, if there are more than
+    one of them.
+    """
+    simple_values = []
+    other_values = []
+    for value in filt.values:
+        if (
+            type(filt) == Any and
+            type(value) == BaseFilter and
+            attribute.type != 'boolean'
+        ):
+            simple_values.append(value)
+        else:
+            other_values.append(value)
 
+    if len(simple_values) < 2:
+        return [], filt.values
+
+    return simple_values, other_values
+
+
+def _get_related_vias_key(attribute, related_vias):
+    if attribute.attribute_id not in related_vias:
+        return None
+
+    return tuple(
+        (
+            None if related_via_attribute is None
+            else _get_attribute_key(related_via_attribute),
+            tuple(servertype_ids),
+        )
+        for related_via_attribute, servertype_ids
+        in related_vias[attribute.attribute_id].items()
+    )
+
+
+def _get_sql_condition(attribute, filt, related_vias, metadata, slots):
+    assert isinstance(filt, BaseFilter)
+
+    if isinstance(filt, (Not, Any)):
+        return _logical_filter_sql_condition(
+            attribute, filt, related_vias, metadata, slots
+        )
+
+    negate = False
+    template = ''
+
+    if attribute.type == 'boolean':
+        # The other filters are already refused by _get_filter_key().
         # TODO: Better return errors for mismatching datatypes than casting
-        negate = not filt.value or filt.value == 'false'
+        negate = _is_false(filt.value)
     elif isinstance(filt, Regexp):
-        template = '{0}::text ~ E' + _raw_sql_escape(filt.value)
+        template = '{0}::text ~ ' + _param_sql(filt, slots)
     elif isinstance(filt, (
         Comparison,
         GreaterThanOrEquals,
         LessThanOrEquals,
     )):
-        template = _basic_comparison_filter_template(attribute, filt)
+        template = _basic_comparison_filter_template(attribute, filt, slots)
     elif isinstance(filt, Overlaps):
-        template = _containment_filter_template(attribute, filt)
+        template = _containment_filter_template(attribute, filt, slots)
     elif isinstance(filt, Empty):
         negate = True
         template = '{0} IS NOT NULL'
     else:
-        template = '{0} = ' + _raw_sql_escape(filt.value)
+        template = '{0} = ' + _param_sql(filt, slots)
 
-    return _covered_sql_condition(attribute, template, negate, related_vias)
+    return _covered_sql_condition(
+        attribute, template, negate, related_vias, metadata
+    )
 
 
-def _covered_sql_condition(attribute, template, negate, related_vias):
+def _covered_sql_condition(
+    attribute, template, negate, related_vias, metadata
+):
     if attribute.type in ['relation', 'reverse', 'supernet', 'domain']:
         template = (
             '{{0}} IN ('
@@ -107,15 +330,17 @@ def _covered_sql_condition(attribute, template, negate, related_vias):
 
     return (
         ('NOT ' if negate else '') +
-        _condition_sql(attribute, template, related_vias)
+        _condition_sql(attribute, template, related_vias, metadata)
     )
 
 
-def _logical_filter_sql_condition(attribute, filt, related_vias):
+def _logical_filter_sql_condition(
+    attribute, filt, related_vias, metadata, slots
+):
     if isinstance(filt, Not):
-        return 'NOT ({0})'.format(
-            _get_sql_condition(attribute, filt.value, related_vias)
-        )
+        return 'NOT ({0})'.format(_get_sql_condition(
+            attribute, filt.value, related_vias, metadata, slots
+        ))
 
     if isinstance(filt, All):
         joiner = ' AND '
@@ -125,36 +350,26 @@ def _logical_filter_sql_condition(attribute, filt, related_vias):
     if not filt.values:
         return 'NOT ({0})'.format(joiner.join(['true', 'false']))
 
-    simple_values = []
-    templates = []
-    for value in filt.values:
-        if type(filt) == Any and type(value) == BaseFilter:
-            simple_values.append(value)
-        else:
-            templates.append(
-                _get_sql_condition(attribute, value, related_vias)
-            )
-
+    simple_values, other_values = _split_simple_values(attribute, filt)
+    templates = [
+        _get_sql_condition(attribute, v, related_vias, metadata, slots)
+        for v in other_values
+    ]
     if simple_values:
-        if len(simple_values) == 1:
-            template = _get_sql_condition(
-                attribute, simple_values[0], related_vias
-            )
-        else:
-            template = _covered_sql_condition(
-                attribute,
-                '{{0}} IN ({0})'.format(', '.join(
-                    _raw_sql_escape(v.value) for v in simple_values
-                )),
-                False,
-                related_vias,
-            )
-        templates.append(template)
+        templates.append(_covered_sql_condition(
+            attribute,
+            '{{0}} = ANY({0}::{1}[])'.format(
+                _param_sql(filt, slots), _get_sql_type(attribute)
+            ),
+            False,
+            related_vias,
+            metadata,
+        ))
 
     return '({0})'.format(joiner.join(templates))
 
 
-def _basic_comparison_filter_template(attribute, filt):
+def _basic_comparison_filter_template(attribute, filt, slots):
     if isinstance(filt, Comparison):
         operator = filt.comparator
     elif isinstance(filt, GreaterThan):
@@ -166,23 +381,20 @@ def _basic_comparison_filter_template(attribute, filt):
     else:
         operator = '<='
 
-    return '{{}} {} {}'.format(
-        operator, _raw_sql_escape(filt.value)
-    )
+    return '{{}} {} {}'.format(operator, _param_sql(filt, slots))
 
 
-def _containment_filter_template(attribute, filt):
+def _containment_filter_template(attribute, filt, slots):    # NOQA: C901
     template = None     # To be formatted 2 times
-    value = filt.value
 
     if attribute.type == 'inet':
         if isinstance(filt, StartsWith):
-            template = "{{0}} >>= {0} AND host({{0}}) = host(0{})"
+            template = '{{0}} >>= {0} AND host({{0}}) = host({0})'
         elif isinstance(filt, Contains):
-            template = "{{0}} >>= {0}"
+            template = '{{0}} >>= {0}'
         elif isinstance(filt, ContainedOnlyBy):
             template = (
-                "{{0}} << {0} AND NOT EXISTS ("
+                '{{0}} << {0} AND NOT EXISTS ('
                 '   SELECT 1 '
                 '   FROM server AS supernet '
                 '   WHERE {{0}} << supernet.intern_ip AND '
@@ -190,16 +402,13 @@ def _containment_filter_template(attribute, filt):
                 ')'
             )
         elif isinstance(filt, ContainedBy):
-            template = "{{0}} <<= {0}"
+            template = '{{0}} <<= {0}'
         else:
-            template = "{{0}} && {0}"
+            template = '{{0}} && {0}'
 
     elif attribute.type == 'string':
         if isinstance(filt, Contains):
-            template = "{{0}} LIKE {0}"
-            value = '{}{}{}'.format(
-                '' if isinstance(filt, StartsWith) else '%', value, '%'
-            )
+            template = '{{0}} LIKE {0}'
         elif isinstance(filt, ContainedBy):
             template = "{0} LIKE '%%' || {{0}} || '%%'"
 
@@ -209,100 +418,254 @@ def _containment_filter_template(attribute, filt):
             .format(type(filt).__name__, attribute)
         )
 
-    return template.format(_raw_sql_escape(value))
+    return template.format(_param_sql(filt, slots))
 
 
-def _condition_sql(attribute, template, related_vias):
+def _condition_sql(attribute, template, related_vias, metadata):
     if attribute.special:
         return template.format('server.' + attribute.special.field)
 
+    # If we come to this point, we must have the item for the entry existing
+    # in the related-vias dictionary.  Keep in mind that it also includes
+    # the directly attached servertype attribute combinations.  They would
+    # have None as the key of the inner dictionary.  If no servertype attribute
+    # combinations had been possible, the caller must have returned an empty
+    # result, before calling this module to get the SQL query.  No filter
+    # is optional in queries after all.
+    related_vias = related_vias[attribute.attribute_id]
+    assert related_vias
+
+    return _related_condition_sql(
+        attribute, template, related_vias, metadata, 'server', 0
+    )
+
+
+def _related_condition_sql(
+    attribute, template, related_vias, metadata, server, depth
+):
+    """Get the SQL condition for the attribute of the given server
+
+    We start with the condition for the attributes the server has on its
+    own.  Then, add the conditions for all possible relations.  They are
+    going to be OR'ed together.  The related servers can have the attribute
+    related again, so we follow the relations in the same way as the query
+    materializer.  Like it, we stop at the point the relations must be
+    going in a circle.  The servertypes need to be checked on the related
+    servers, because they can have the attribute in different ways.
+    """
+    relation_conditions = []
+    for related_via_attribute, servertype_ids in related_vias.items():
+        if related_via_attribute is None:
+            relation_condition = _real_condition_sql(
+                attribute, template, server
+            )
+        elif depth < metadata.related_attribute_count:
+            relation_condition = _relation_condition_sql(
+                attribute,
+                template,
+                related_via_attribute,
+                servertype_ids,
+                metadata,
+                server,
+                depth,
+            )
+        else:
+            relation_condition = 'false'
+        relation_conditions.append((relation_condition, servertype_ids))
+
+    if not relation_conditions:
+        return 'false'
+    if len(relation_conditions) == 1 and depth == 0:
+        return relation_conditions[0][0]
+
+    return '({0})'.format(' OR '.join(
+        '({0} AND {1}.servertype_id IN ({2}))'
+        .format(relation_condition, server, ', '.join(
+            "'{0}'".format(s) for s in servertype_ids)
+        )
+        for relation_condition, servertype_ids in relation_conditions
+    ))
+
+
+def _relation_condition_sql(
+    attribute,
+    template,
+    related_via_attribute,
+    servertype_ids,
+    metadata,
+    server,
+    depth,
+):
+    """Get the SQL condition for the attribute of the related servers
+
+    The attribute to relate via can be related again, so we get it through
+    the same function as the ones we filter on.
+    """
+    related = 'rel{0}'.format(depth + 1)
+
+    return _exists_sql(Server, related, (
+        _related_condition_sql(
+            related_via_attribute,
+            '{{0}} = {0}.server_id'.format(related),
+            _get_servertype_related_vias(
+                metadata, related_via_attribute, servertype_ids
+            ),
+            metadata,
+            server,
+            depth + 1,
+        ),
+        _related_condition_sql(
+            attribute,
+            template,
+            _get_servertype_related_vias(
+                metadata,
+                attribute,
+                _get_target_servertype_ids(metadata, related_via_attribute),
+            ),
+            metadata,
+            related,
+            depth + 1,
+        ),
+    ))
+
+
+def _real_condition_sql(attribute, template, server):
+    """Get the SQL condition for the attribute the server has on its own"""
     if attribute.type == 'supernet':
         return _exists_sql(Server, 'sub', (
             "sub.servertype_id = '{0}'".format(attribute.target_servertype_id),
-            'sub.intern_ip >>= server.intern_ip',
+            'sub.intern_ip >>= {0}.intern_ip'.format(server),
             template.format('sub.server_id'),
         ))
     if attribute.type == 'domain':
         return _exists_sql(Server, 'sub', (
             "sub.servertype_id = '{0}'".format(attribute.target_servertype_id),
-            "server.hostname ~ ('\\A[^\.]+\.' || regexp_replace(",
-            "sub.hostname, '(\*|\-|\.)', '\\\1', 'g') || '\\Z')",
+            'sub.hostname = ' + _domain_sql(server + '.hostname'),
             template.format('sub.server_id'),
         ))
     if attribute.type == 'reverse':
         return _exists_sql(ServerRelationAttribute, 'sub', (
             "sub.attribute_id = '{0}'".format(attribute.reversed_attribute_id),
-            'sub.value = server.server_id',
+            'sub.value = {0}.server_id'.format(server),
             template.format('sub.server_id'),
         ))
 
-    return _real_condition_sql(attribute, template, related_vias)
+    return _exists_sql(ServerAttribute.get_model(attribute.type), 'sub', (
+        '{0}.server_id = sub.server_id'.format(server),
+        "sub.attribute_id = '{0}'".format(attribute.attribute_id),
+        template.format('sub.value'),
+    ))
 
 
-def _real_condition_sql(attribute, template, related_vias):
-    model = ServerAttribute.get_model(attribute.type)
-    assert model is not None
+def _get_servertype_related_vias(metadata, attribute, servertype_ids):
+    """Get the related-vias of the attribute on the given servertypes
+
+    They are in the same format as the items of the dictionary prepared
+    by the query executer module.  None means all of the servertypes.
+    """
+    related_vias = {}
+    for sa in metadata.attribute_servertype_attributes.get(
+        attribute.attribute_id, []
+    ):
+        if servertype_ids is not None and sa.servertype_id not in (
+            servertype_ids
+        ):
+            continue
+        if sa.related_via_attribute_id:
+            related_via_attribute = metadata.attribute_lookup[
+                sa.related_via_attribute_id
+            ]
+        else:
+            related_via_attribute = None
+        related_vias.setdefault(related_via_attribute, []).append(
+            sa.servertype_id
+        )
 
-    # If we come to this point, we must have the item for the entry existing
-    # in the related-vias dictionary.  Keep in mind that it also includes
-    # the directly attached servertype attribute combinations.  They would
-    # have None as the key of the inner dictionary.  If no servertype attribute
-    # combinations had been possible, the caller must have returned an empty
-    # result, before calling this module to get the SQL query.  No filter
-    # is optional in queries after all.
-    related_vias = related_vias[attribute.attribute_id]
-    assert related_vias
+    return related_vias
 
-    # We start with the condition for the attributes the server has on
-    # its own.  Then, add the conditions for all possible relations.  They
-    # are going to be OR'ed together.
-    relation_conditions = []
-    for related_via_attribute, servertype_ids in related_vias.items():
-        if related_via_attribute is None:
-            # The condition for directly attached attributes
-            relation_condition = 'server.server_id = sub.server_id'
-        elif related_via_attribute.type == 'supernet':
-            relation_condition = _exists_sql(Server, 'rel1', (
-                "rel1.servertype_id = '{0}'".format(
-                    related_via_attribute.target_servertype_id
-                ),
-                'rel1.intern_ip >>= server.intern_ip',
-                'rel1.server_id = sub.server_id',
-            ))
-        elif related_via_attribute.type == 'reverse':
-            relation_condition = _exists_sql(ServerRelationAttribute, 'rel1', (
-                "rel1.attribute_id = '{0}'".format(
-                    related_via_attribute.reversed_attribute_id
-                ),
-                'rel1.value = server.server_id',
-                'rel1.server_id = sub.server_id',
-            ))
-        else:
-            assert related_via_attribute.type == 'relation'
-            relation_condition = _exists_sql(ServerRelationAttribute, 'rel1', (
-                "rel1.attribute_id = '{0}'"
-                .format(related_via_attribute.attribute_id),
-                'rel1.server_id = server.server_id',
-                'rel1.value = sub.server_id',
-            ))
-        relation_conditions.append((relation_condition, servertype_ids))
 
-    if len(relation_conditions) == 1:
-        mixed_relation_condition = relation_conditions[0][0]
-    else:
-        mixed_relation_condition = '({0})'.format(' OR '.join(
-            '({0} AND server.servertype_id IN ({1}))'
-            .format(relation_condition, ', '.join(
-                "'{0}'".format(s) for s in servertype_ids)
+def _get_target_servertype_ids(metadata, attribute):
+    """Get the servertypes the attribute can relate the servers to
+
+    It returns None, if they can be from any servertype.
+    """
+    if attribute.type == 'reverse':
+        return {
+            sa.servertype_id
+            for sa in metadata.attribute_servertype_attributes.get(
+                attribute.reversed_attribute_id, []
             )
-            for relation_condition, servertype_ids in relation_conditions
+        }
+    if attribute.target_servertype_id:
+        return {attribute.target_servertype_id}
+
+    return None
+
+
+def _order_by_sql_expressions(attribute, servertype_ids):
+    """Get the SQL expressions to order the servers by the attribute
+
+    We keep the same order as the query materializer: the servers of
+    the servertypes without the attribute come last, and the ones which
+    doesn't have a value come first.  The strings are compared by their
+    characters regardless of the collation of the database.
+    """
+    if attribute.special:
+        column = 'server.' + attribute.special.field
+        if attribute.type == 'string':
+            return [column + ' COLLATE "C"']
+        return [column + ' NULLS FIRST']
+
+    if not servertype_ids:
+        return []
+
+    if attribute.type == 'boolean':
+        value = _exists_sql(ServerAttribute.get_model('boolean'), 'sub', (
+            'sub.server_id = server.server_id',
+            "sub.attribute_id = '{0}'".format(attribute.attribute_id),
         ))
+    else:
+        if attribute.type == 'relation':
+            column = 'target.hostname COLLATE "C"'
+            join = ' JOIN server AS target ON target.server_id = sub.value'
+        elif attribute.type == 'string':
+            column = 'sub.value COLLATE "C"'
+            join = ''
+        else:
+            column = 'sub.value'
+            join = ''
+        value = (
+            '(SELECT {0} FROM {1} AS sub{2} '
+            'WHERE sub.server_id = server.server_id AND '
+            "sub.attribute_id = '{3}')"
+            .format(
+                column,
+                ServerAttribute.get_model(attribute.type)._meta.db_table,
+                join,
+                attribute.attribute_id,
+            )
+        )
+    servertypes_sql = ', '.join("'{0}'".format(s) for s in servertype_ids)
 
-    return _exists_sql(model, 'sub', (
-        mixed_relation_condition,
-        "sub.attribute_id = '{0}'".format(attribute.attribute_id),
-        template.format('sub.value'),
-    ))
+    return [
+        'server.servertype_id NOT IN ({0})'.format(servertypes_sql),
+        'CASE WHEN server.servertype_id IN ({0}) THEN {1} END NULLS FIRST'
+        .format(servertypes_sql, value),
+    ]
+
+
+def _domain_sql(column):
+    """Get the SQL expression for the domain of the hostname
+
+    The domain is the part after the first dot.  The expression must be
+    kept the same as the one of the index on the server table, so that
+    the database can find the servers of a domain using it.
+    """
+    return (
+        "CASE WHEN strpos({0}, '.') > 1 "
+        "THEN substr({0}, strpos({0}, '.') + 1) END"
+        .format(column)
+    )
 
 
 def _exists_sql(model, alias, conditions):
@@ -311,20 +674,18 @@ def _exists_sql(model, alias, conditions):
     )
 
 
-def _raw_sql_escape(value):
-    try:
-        value = str(value)
-    except UnicodeEncodeError as error:
-        raise FilterValueError(str(error))
+def _get_sql_type(attribute):
+    """Get the SQL type to compare the values of the attribute
 
-    if "'" in value:
-        raise FilterValueError('Single quote cannot be used')
+    The related attributes are compared by the hostnames of the servers.
+    """
+    return _SQL_TYPES.get(attribute.type, 'text')
 
-    if value.endswith('\\'):
-        raise FilterValueError(
-            'Escape character cannot be used in the end'
-        )
 
-    value = value.replace('{', '{{').replace('}', '}}').replace('%', '%%')
+def _param_sql(filt, slots):
+    """Get the placeholder for the value of the filter"""
+    return '%({})s'.format(slots[id(filt)])
+
 
-    return "'" + value + "'"
+def _is_false(value):
+    return not value or value == 'false'
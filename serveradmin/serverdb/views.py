@@ -23,9 +23,11 @@ from serveradmin.serverdb.models import (
     ChangeDelete,
     Server, ServertypeAttribute)
 from serveradmin.serverdb.query_committer import CommitError, commit_query
+from serveradmin.serverdb.routers import read_replica
 
 
 @login_required
+@read_replica()
 def changes(request):
     context = dict()
     column_filter = dict()
@@ -79,6 +81,7 @@ def changes(request):
 
 
 @login_required
+@read_replica()
 def history(request):
     object_id = request.GET.get('object_id')
     commit_id = request.GET.get('commit_id')
@@ -1,6 +1,7 @@
-from django.db import connection, ProgrammingError
+from django.db import ProgrammingError
 
 from serveradmin.serverdb.models import Attribute, ServerAttribute, Server
+from serveradmin.serverdb.routers import get_read_connection
 from django.core.exceptions import ObjectDoesNotExist
 
 
@@ -51,7 +52,7 @@ def _specials_value_startswith(attribute_id, search_string, limit=20):
 
     column_name = Attribute.specials[attribute_id].special.field
 
-    with connection.cursor() as cursor:
+    with get_read_connection().cursor() as cursor:
         # This is safe because field_name comes from us
         sql = "SELECT DISTINCT {} FROM server WHERE {} LIKE %s ORDER BY {} ASC LIMIT {}".format(
             column_name, column_name, column_name, limit)
@@ -24,12 +24,13 @@ from adminapi.filters import Any, ContainedOnlyBy, filter_classes
 from adminapi.parse import parse_query
 from adminapi.request import json_encode_extra
 from serveradmin.dataset import Query
+from serveradmin.serverdb.metadata import get_metadata
 from serveradmin.serverdb.models import (
     Servertype,
     Attribute,
-    ServertypeAttribute,
     Server)
 from serveradmin.serverdb.query_committer import commit_query
+from serveradmin.serverdb.routers import read_replica
 from serveradmin.servershell.helper.autocomplete import \
     attribute_value_startswith, attribute_startswith
 
@@ -55,7 +56,10 @@ def index(request):
 
     request.session['shown_attributes'] = shown_attributes
 
-    attributes = list(Attribute.objects.all())
+    metadata = get_metadata()
+    attributes = sorted(
+        metadata.attributes.values(), key=lambda a: a.attribute_id
+    )
     attributes.extend(Attribute.specials.values())
     attributes_json = list()
     for attribute in attributes:
@@ -90,6 +94,7 @@ def index(request):
 
 
 @login_required
+@read_replica()
 def autocomplete(request):
     autocomplete_list = list()
     hostname = request.GET.get('hostname')
@@ -144,20 +149,18 @@ def get_results(request):
         restrict = shown_attributes.copy()
         if 'servertype' not in restrict:
             restrict.append('servertype')
-        query = Query(parse_query(term), restrict, order_by)
-
-        # TODO: Using len is terribly slow for large datasets because it has
-        #  to query all objects but we cannot use count which is available on
-        #  Django QuerySet
-        num_servers = len(query)
+        query = Query(
+            parse_query(term), restrict, order_by, limit=limit, offset=offset
+        )
+        # The page is fetched first, so that counting reuses its total.
+        servers = list(query)
+        num_servers = query.count()
     except (DatatypeError, ObjectDoesNotExist, ValidationError) as error:
         return HttpResponse(json.dumps({
             'status': 'error',
             'message': str(error)
         }))
 
-    servers = list(islice(query, offset, offset + limit))
-
     # Save settings across requests and tabs
     request.session['term'] = term
     request.session['limit'] = limit
@@ -170,15 +173,18 @@ def get_results(request):
     default_editable.remove('object_id')
 
     editable_attributes = dict()
+    metadata = get_metadata()
     for servertype_id in servertype_ids:
         editable_attributes[servertype_id] = default_editable.copy()
-    for sa in ServertypeAttribute.objects.filter(
-            servertype_id__in=servertype_ids,
-            attribute_id__in=shown_attributes,
-            related_via_attribute_id__isnull=True,
-            attribute__readonly=False,
-    ):
-        editable_attributes[sa.servertype_id].append(sa.attribute_id)
+        servertype_attributes = metadata.servertype_attributes[servertype_id]
+        for attribute_id in shown_attributes:
+            sa = servertype_attributes.get(attribute_id)
+            if (
+                sa is not None and
+                sa.related_via_attribute_id is None and
+                not sa.attribute.readonly
+            ):
+                editable_attributes[servertype_id].append(attribute_id)
 
     return HttpResponse(json.dumps({
         'status': 'success',
@@ -213,7 +219,7 @@ def edit(request):
         server = Query({'object_id': request.GET['object_id']}, None).get()
     else:
         servertype = request.POST.get('attr_servertype')
-        if not Servertype.objects.filter(pk=servertype).exists():
+        if servertype not in get_metadata().servertypes:
             raise Http404('Servertype {} does not exist'.format(servertype))
         server = Query().new_object(servertype)
 
@@ -223,10 +229,7 @@ def edit(request):
 def _edit(request, server, edit_mode=False, template='edit'):  # NOQA: C901
     invalid_attrs = set()
     if edit_mode and request.POST:
-        attribute_lookup = {a.pk: a for a in Attribute.objects.filter(
-            attribute_id__in=(k[len('attr_'):] for k in request.POST.keys())
-        )}
-        attribute_lookup.update(Attribute.specials)
+        attribute_lookup = get_metadata().attribute_lookup
         for key, value in request.POST.items():
             if not key.startswith('attr_'):
                 continue
@@ -278,14 +281,10 @@ def _edit(request, server, edit_mode=False, template='edit'):  # NOQA: C901
         if invalid_attrs:
             messages.error(request, 'Attributes contains invalid values')
 
-    servertype = Servertype.objects.get(pk=server['servertype'])
-    attribute_lookup = {a.pk: a for a in Attribute.objects.filter(
-        attribute_id__in=(server.keys())
-    )}
-    attribute_lookup.update(Attribute.specials)
-    servertype_attributes = {sa.attribute_id: sa for sa in (
-        ServertypeAttribute.objects.filter(servertype_id=server['servertype'])
-    )}
+    metadata = get_metadata()
+    servertype = metadata.get_servertype(server['servertype'])
+    attribute_lookup = metadata.attribute_lookup
+    servertype_attributes = metadata.servertype_attributes[servertype.pk]
 
     fields = []
     fields_set = set()
@@ -387,10 +386,11 @@ def clone_object(request):
     try:
         old_object = Query(
             {'object_id': request.GET.get('object_id')},
-            list(Attribute.specials) + list(
-                Attribute.objects.filter(clone=True)
-                    .values_list('attribute_id', flat=True)
-            ),
+            list(Attribute.specials) + [
+                a.attribute_id
+                for a in get_metadata().attributes.values()
+                if a.clone
+            ],
         ).get()
     except ValidationError as e:
         messages.error(request, e.message)
@@ -418,7 +418,8 @@ def choose_ip_addr(request):
         {
             'servertype': Any(*(
                 s.servertype_id
-                for s in Servertype.objects.filter(ip_addr_type='network')
+                for s in get_metadata().servertypes.values()
+                if s.ip_addr_type == 'network'
             )),
             'intern_ip': ContainedOnlyBy(network),
         },
@@ -22,6 +22,17 @@ DATABASES = {
     },
 }
 
+# Aliases of the databases in DATABASES to run the queries on instead of
+# the default one.  They are expected to be streaming replicas of it.
+# One of them is chosen randomly for every query.  The changes always go to
+# the default database.  With REPLICA_READ_YOUR_WRITES, the processes keep
+# running the queries on the default database after they have changed
+# anything until the chosen replica catches up.
+REPLICA_DATABASES = []
+REPLICA_READ_YOUR_WRITES = False
+
+DATABASE_ROUTERS = ['serveradmin.serverdb.routers.ReplicaRouter']
+
 MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -164,6 +175,12 @@ LOGGING = {
 
 OBJECTS_PER_PAGE = 25
 
+# Number of the recent query results every process keeps in memory, and
+# the number of objects a result can have at most to be kept.  The results
+# are kept until the data changes.  Set the size to 0 to disable the cache.
+QUERY_CACHE_SIZE = 100
+QUERY_CACHE_MAX_OBJECTS = 1000
+
 GRAPHITE_SPRITE_WIDTH = 150
 GRAPHITE_SPRITE_HEIGHT = 100
 GRAPHITE_SPRITE_PARAMS = (
@@ -0,0 +1,101 @@
+"""Serveradmin
+
+Copyright (c) 2019 InnoGames GmbH
+"""
+
+import json
+import time
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.test import TransactionTestCase
+
+from adminapi.dataset import STREAM_ERROR, STREAM_FOOTER, STREAM_HEADER
+from adminapi.request import calc_security_token
+from serveradmin.api.views import _stream_query_response
+from serveradmin.apps.models import Application
+
+
+class TestDatasetQuery(TransactionTestCase):
+    fixtures = ['test_dataset.json']
+
+    def setUp(self):
+        self.app = Application.objects.create(
+            name='test', owner=User.objects.first(), superuser=True
+        )
+
+    def _query(self, data, **headers):
+        body = json.dumps(data)
+        timestamp = int(time.time())
+        return self.client.post(
+            '/api/dataset/query',
+            body,
+            content_type='application/x-json',
+            HTTP_X_TIMESTAMP=str(timestamp),
+            HTTP_X_APPLICATION=self.app.app_id,
+            HTTP_X_SECURITYTOKEN=calc_security_token(
+                self.app.auth_token, timestamp, body
+            ),
+            **headers
+        )
+
+    def test_stream(self):
+        response = self._query({
+            'filters': {'servertype': 'test2'},
+            'restrict': ['hostname'],
+            'stream': True,
+        })
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], STREAM_HEADER)
+        self.assertEqual(lines[-1], STREAM_FOOTER)
+        self.assertEqual(json.loads(''.join(lines))['result'], [
+            {'hostname': 'test1'},
+            {'hostname': 'test2'},
+            {'hostname': 'test3'},
+        ])
+
+    def test_stream_error(self):
+        # The errors on the first batch are returned instead of streaming.
+        response = self._query({
+            'filters': {'game_world': {'GreaterThan': 'a'}},
+            'stream': True,
+        })
+        self.assertFalse(response.streaming)
+        self.assertEqual(json.loads(response.content.decode())['status'],
+                         'error')
+
+    def test_stream_later_error(self):
+        def batches():
+            yield [{'hostname': 'test0'}]
+            raise ValidationError('Failed')
+
+        lines = ''.join(_stream_query_response(batches())).splitlines()
+        self.assertEqual(lines[0], STREAM_HEADER)
+        self.assertNotIn(STREAM_FOOTER, lines)
+        self.assertTrue(lines[-1].startswith(STREAM_ERROR))
+        self.assertEqual(json.loads(lines[-1][len(STREAM_ERROR):]), {
+            'status': 'error', 'type': 'ValueError', 'message': "['Failed']",
+        })
+        with self.assertRaises(ValueError):
+            json.loads(''.join(lines))
+
+    def test_etag(self):
+        data = {'filters': {'servertype': 'test2'}, 'restrict': ['hostname']}
+        response = self._query(data)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        for header in (
+            etag,
+            'W/' + etag,
+            '"other", ' + etag,
+            '"other",W/' + etag,
+            '*',
+        ):
+            response = self._query(data, HTTP_IF_NONE_MATCH=header)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+
+        for header in ('"other"', 'W/"other", ' + etag[1:]):
+            response = self._query(data, HTTP_IF_NONE_MATCH=header)
+            self.assertEqual(response.status_code, 200)
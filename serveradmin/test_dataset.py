@@ -6,15 +6,36 @@ Copyright (c) 2019 InnoGames GmbH
 from ipaddress import IPv4Address
 from datetime import datetime, timezone, tzinfo, timedelta
 from django.contrib.auth.models import User
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.db import connection
 from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 
+from adminapi.exceptions import DatasetError, FilterValueError
 from adminapi.filters import (
+    All,
     Any,
+    ContainedBy,
+    Contains,
+    Empty,
+    GreaterThan,
     Not,
     Regexp,
     StartsWith,
 )
+from serveradmin.access_control.models import AccessControlGroup
 from serveradmin.dataset import Query
+from serveradmin.serverdb.models import (
+    Attribute,
+    ServerNumberAttribute,
+    Servertype,
+    ServertypeAttribute,
+)
+from serveradmin.serverdb.query_committer import commit_query
+from serveradmin.serverdb.query_executer import (
+    get_query_etag,
+    stream_query,
+)
 
 
 class TestQuery(TransactionTestCase):
@@ -61,6 +82,13 @@ class TestQuery(TransactionTestCase):
         self.assertNotIn('test2', hostnames)
         self.assertIn('test3', hostnames)
 
+    def test_filter_any_typed(self):
+        hostnames = {s['hostname'] for s in Query({
+            'game_world': Any(1, 10, 11),
+            'intern_ip': Any('10.16.0.2', '10.16.0.4'),
+        })}
+        self.assertEqual(hostnames, {'test1', 'test3'})
+
     def test_not(self):
         s = Query({'os': Not('squeeze')}).get()
         self.assertEqual(s['hostname'], 'test0')
@@ -69,14 +97,415 @@ class TestQuery(TransactionTestCase):
         s = Query({'os': Not(Any('squeeze', 'lenny'))}).get()
         self.assertEqual(s['hostname'], 'test0')
 
+    def test_filter_nested(self):
+        hostnames = {s['hostname'] for s in Query({
+            'hostname': Any(Any('test1', Any()), Not(Not('test3'))),
+            'os': All(Not(Not('squeeze')), 'squeeze', All()),
+        })}
+        self.assertEqual(hostnames, {'test1', 'test3'})
+
+    def test_filter_contradiction(self):
+        self.assertEqual(len(Query({'os': All('squeeze', 'wheezy')})), 0)
+        self.assertEqual(len(Query({'hostname': Any(Any(), Not(All()))})), 0)
+
+    def test_filter_boolean(self):
+        Attribute.objects.create(
+            attribute_id='monitored', type='boolean', regexp=r'\A.*\Z'
+        )
+        ServertypeAttribute.objects.create(
+            servertype_id='test0', attribute_id='monitored'
+        )
+        s = Query({'monitored': False}).get()
+        self.assertEqual(s['hostname'], 'test0')
+        self.assertEqual(len(Query({'monitored': Not(False)})), 0)
+
+        for filt in (Empty(), Not(Empty()), Any(Empty(), True)):
+            with self.assertRaises(FilterValueError):
+                Query({'monitored': filt}).get()
+
     def test_startswith(self):
         s = Query({'os': StartsWith('whee')}).get()
         self.assertEqual(s['hostname'], 'test0')
 
+    def test_startswith_escape(self):
+        self.assertEqual(len(Query({'os': StartsWith('whe_')})), 0)
+        self.assertEqual(len(Query({'os': Contains('%')})), 0)
+
+    def test_filter_pattern(self):
+        Attribute.objects.create(
+            attribute_id='comment', type='string', regexp=r'\A.*\Z'
+        )
+        ServertypeAttribute.objects.create(
+            servertype_id='test2', attribute_id='comment'
+        )
+        q = Query({'servertype': 'test2'}, ['hostname', 'comment'])
+        for server in q:
+            server['comment'] = {
+                'test1': 'a_b', 'test2': 'axb', 'test3': '50%\\x'
+            }[server['hostname']]
+        q.commit(user=User.objects.first())
+
+        # The special characters of LIKE are matched literally.
+        for filt, hostnames in (
+            (StartsWith('a_'), {'test1'}),
+            (StartsWith('_'), set()),
+            (Contains('_'), {'test1'}),
+            (Contains('%'), {'test3'}),
+            (Contains('0%\\'), {'test3'}),
+            (StartsWith('%'), set()),
+            (Contains('\\'), {'test3'}),
+            (Regexp('^a.b$'), {'test1', 'test2'}),
+            (Regexp('_'), {'test1'}),
+            (Regexp(r'%\\x$'), {'test3'}),
+            (Not(Contains('_')), {'test2', 'test3'}),
+        ):
+            self.assertEqual(
+                {s['hostname'] for s in Query({'comment': filt})},
+                hostnames,
+            )
+
     def test_startswith_servertype(self):
         q = Query({'servertype': StartsWith('tes')})
         self.assertEqual(len(q), 4)
 
+    def test_query_same_shape(self):
+        s = Query({'os': 'wheezy'}).get()
+        self.assertEqual(s['hostname'], 'test0')
+        q = Query({'os': 'squeeze'})
+        self.assertEqual(len(q), 3)
+
+    def test_filter_quote(self):
+        q = Query({'hostname': Any("test0'", 'test1\\')})
+        self.assertEqual(len(q), 0)
+
+    def test_filter_contains(self):
+        s = Query({'os': Contains('hee')}).get()
+        self.assertEqual(s['hostname'], 'test0')
+
+    def test_limit_offset(self):
+        q = Query({'servertype': 'test2'}, limit=2, offset=1)
+        self.assertEqual([s['hostname'] for s in q], ['test2', 'test3'])
+        self.assertEqual(q.count(), 3)
+
+    def test_limit_offset_order_by(self):
+        q = Query({}, ['game_world'], ['game_world'], limit=2, offset=1)
+        self.assertEqual([s['game_world'] for s in q], [2, 10])
+        self.assertEqual(q.count(), 4)
+
+    def test_query_matched(self):
+        # The attributes are joined with the query filtering the servers.
+        with CaptureQueriesContext(connection) as queries:
+            game_worlds = {
+                s['hostname']: s['game_world']
+                for s in Query(
+                    {'os': 'squeeze', 'game_world': Not(2)},
+                    ['hostname', 'game_world'],
+                )
+            }
+        self.assertEqual(game_worlds, {'test1': 1, 'test3': 10})
+        self.assertTrue(any(
+            'AS filtered' in q['sql'] for q in queries.captured_queries
+        ))
+
+    def test_query_attribute_types(self):
+        Attribute.objects.create(
+            attribute_id='monitored', type='boolean', regexp=r'\A.*\Z'
+        )
+        Attribute.objects.create(
+            attribute_id='hypervisor',
+            type='relation',
+            target_servertype_id='test0',
+            regexp=r'\A.*\Z',
+        )
+        for servertype_id, attribute_id in (
+            ('test0', 'monitored'), ('test2', 'hypervisor')
+        ):
+            ServertypeAttribute.objects.create(
+                servertype_id=servertype_id, attribute_id=attribute_id
+            )
+        dt = datetime(2019, 1, 1, tzinfo=timezone.utc)
+        user = User.objects.first()
+        q = Query({'hostname': 'test0'}, ['database', 'last_edited'])
+        s = q.get()
+        s['database'].add('db0')
+        s['last_edited'] = dt
+        q.commit(user=user)
+        q = Query({'hostname': 'test1'}, ['hypervisor'])
+        q.get()['hypervisor'] = 'test0'
+        q.commit(user=user)
+
+        # The values of all of the tables are selected with a single query.
+        with CaptureQueriesContext(connection) as queries:
+            servers = list(Query({'hostname': Any('test0', 'test1')}, [
+                'hostname',
+                'os',
+                'game_world',
+                'database',
+                'last_edited',
+                'monitored',
+                'hypervisor',
+            ]))
+        self.assertEqual(len([
+            c for c in queries.captured_queries if 'UNION ALL' in c['sql']
+        ]), 1)
+        self.assertEqual(servers[0]['os'], 'wheezy')
+        self.assertEqual(servers[0]['database'], {'db0'})
+        self.assertEqual(servers[0]['last_edited'], dt)
+        self.assertEqual(servers[0]['monitored'], False)
+        self.assertEqual(servers[1]['os'], 'squeeze')
+        self.assertEqual(servers[1]['game_world'], 1)
+        self.assertEqual(servers[1]['hypervisor'], 'test0')
+
+    def test_query_supernet(self):
+        Servertype.objects.create(
+            servertype_id='network', ip_addr_type='network'
+        )
+        Attribute.objects.create(
+            attribute_id='network',
+            type='supernet',
+            target_servertype_id='network',
+            readonly=True,
+            regexp=r'\A.*\Z',
+        )
+        for servertype_id in ('test0', 'test2'):
+            ServertypeAttribute.objects.create(
+                servertype_id=servertype_id, attribute_id='network'
+            )
+        commit_query(created=[
+            {'hostname': h, 'servertype': 'network', 'intern_ip': i}
+            for h, i in (
+                ('net0', '10.0.0.0/16'),
+                ('net1', '10.16.0.0/30'),
+                ('net2', '10.16.0.8/29'),
+            )
+        ], user=User.objects.first())
+
+        # The supernets of all of the servers are selected with a single
+        # query.  The last server is not in any of the networks.
+        with CaptureQueriesContext(connection) as queries:
+            networks = {
+                s['hostname']: s['network']
+                for s in Query({'servertype': Any('test0', 'test2')}, [
+                    'hostname', 'network'
+                ])
+            }
+        self.assertEqual(networks, {
+            'test0': 'net1', 'test1': 'net1', 'test2': 'net1', 'test3': None,
+        })
+        self.assertEqual(len([
+            c for c in queries.captured_queries
+            if 'JOIN server AS supernet' in c['sql']
+        ]), 1)
+
+        hostnames = {s['hostname'] for s in Query({'network': 'net1'})}
+        self.assertEqual(hostnames, {'test0', 'test1', 'test2'})
+        self.assertEqual(len(Query({'network': Any('net0', 'net2')})), 0)
+
+    def test_query_domain(self):
+        Servertype.objects.create(servertype_id='domain', ip_addr_type='null')
+        Attribute.objects.create(
+            attribute_id='domain',
+            type='domain',
+            target_servertype_id='domain',
+            readonly=True,
+            regexp=r'\A.*\Z',
+        )
+        for servertype_id in ('test0', 'test2'):
+            ServertypeAttribute.objects.create(
+                servertype_id=servertype_id, attribute_id='domain'
+            )
+        user = User.objects.first()
+        commit_query(created=[
+            {'hostname': h, 'servertype': 'domain', 'intern_ip': None}
+            for h in ('example.com', 'sub.example.com')
+        ], user=user)
+        q = Query({'hostname': Any('test1', 'test2')})
+        for server in q:
+            server['hostname'] += {
+                'test1': '.example.com', 'test2': '.sub.example.com'
+            }[server['hostname']]
+        q.commit(user=user)
+
+        # The domain is the part after the first dot.  The hostnames
+        # without a dot have no domain.
+        domains = {
+            s['hostname']: s['domain']
+            for s in Query({'servertype': Any('test0', 'test2')}, [
+                'hostname', 'domain'
+            ])
+        }
+        self.assertEqual(domains, {
+            'test0': None,
+            'test1.example.com': 'example.com',
+            'test2.sub.example.com': 'sub.example.com',
+            'test3': None,
+        })
+
+        s = Query({'domain': 'example.com'}).get()
+        self.assertEqual(s['hostname'], 'test1.example.com')
+        hostnames = {
+            s['hostname'] for s in Query({'domain': Regexp('^sub\\.')})
+        }
+        self.assertEqual(hostnames, {'test2.sub.example.com'})
+        hostnames = {
+            s['hostname'] for s in Query({
+                'servertype': Any('test0', 'test2'),
+                'domain': Not(Regexp('example')),
+            })
+        }
+        self.assertEqual(hostnames, {'test0', 'test3'})
+
+    def test_query_matched_page(self):
+        # The servers ordered by the materializer are not the ones of
+        # the filtering query anymore.
+        q = Query(
+            {'os': 'squeeze'}, ['hostname', 'game_world'],
+            ['database', 'hostname'], limit=2, offset=1,
+        )
+        self.assertEqual(
+            [(s['hostname'], s['game_world']) for s in q],
+            [('test2', 2), ('test3', 10)],
+        )
+
+    def test_iter_pages(self):
+        pages = list(Query({}).iter_pages(3))
+        self.assertEqual(len(pages), 2)
+        self.assertEqual(
+            [s['hostname'] for p in pages for s in p],
+            ['test0', 'test1', 'test2', 'test3'],
+        )
+        self.assertEqual(pages[1].count(), 4)
+
+    def test_iter_pages_order_by(self):
+        with self.assertRaises(DatasetError):
+            Query({}, None, ['os']).iter_pages(3)
+
+    def test_stream_query(self):
+        batches = list(stream_query({}, ['hostname', 'intern_ip'], None, 3))
+        self.assertEqual([len(b) for b in batches], [3, 1])
+        self.assertEqual(batches[0][0]['hostname'], 'test0')
+        self.assertEqual(batches[0][0]['intern_ip'], IPv4Address('10.16.0.1'))
+
+    def test_stream(self):
+        hostnames = [s['hostname'] for s in Query({'os': 'squeeze'}).stream()]
+        self.assertEqual(hostnames, ['test1', 'test2', 'test3'])
+
+    def test_filter_inet(self):
+        q = Query({'intern_ip': ContainedBy('10.16.0.0/30')})
+        self.assertEqual(len(q), 3)
+        s = Query({'intern_ip': StartsWith('10.16.0.1')}).get()
+        self.assertEqual(s['hostname'], 'test0')
+
+    def _create_related_owners(self, project_related_via=None):
+        """Give the servers the owners of their projects
+
+        The project p1 has the owner.  The servers of test0 are on it.
+        The servers of test2 are on their hypervisors of test0.
+        """
+        Servertype.objects.create(servertype_id='project', ip_addr_type='null')
+        Attribute.objects.create(
+            attribute_id='owner', type='string', regexp=r'\A.*\Z'
+        )
+        for attribute_id, target_servertype_id in (
+            ('project', 'project'), ('hypervisor', 'test0')
+        ):
+            Attribute.objects.create(
+                attribute_id=attribute_id,
+                type='relation',
+                target_servertype_id=target_servertype_id,
+                regexp=r'\A.*\Z',
+            )
+        for servertype_id, attribute_id, related_via_attribute_id in (
+            ('project', 'owner', None),
+            ('test0', 'project', None),
+            ('test0', 'owner', 'project'),
+            ('test2', 'hypervisor', None),
+            ('test2', 'project', 'hypervisor'),
+            ('test2', 'owner', project_related_via),
+        ):
+            ServertypeAttribute.objects.create(
+                servertype_id=servertype_id,
+                attribute_id=attribute_id,
+                related_via_attribute_id=related_via_attribute_id,
+            )
+
+        user = User.objects.first()
+        commit_query(created=[
+            {
+                'hostname': 'p1',
+                'servertype': 'project',
+                'intern_ip': None,
+                'owner': 'alice',
+            },
+        ], user=user)
+        q = Query({'servertype': 'test2'}, ['hypervisor'])
+        for server in q:
+            server['hypervisor'] = 'test0'
+        q.commit(user=user)
+        q = Query({'hostname': 'test0'}, ['project'])
+        q.get()['project'] = 'p1'
+        q.commit(user=user)
+
+    def test_filter_related_chain(self):
+        # The owners of test2 are related via the hypervisors, and the ones
+        # of the hypervisors via the projects.
+        self._create_related_owners('hypervisor')
+        self._test_related_owners()
+
+    def test_filter_related_via_related(self):
+        # The owners of test2 are related via the projects which are related
+        # via the hypervisors.
+        self._create_related_owners('project')
+        self._test_related_owners()
+
+    def test_query_nested_joins(self):
+        self._create_related_owners('hypervisor')
+        with CaptureQueriesContext(connection) as queries:
+            servers = list(Query({'servertype': Any('test0', 'test2')}, [
+                'hostname',
+                'os',
+                {'hypervisor': [
+                    'hostname', 'os', {'project': ['hostname', 'owner']}
+                ]},
+                {'project': ['owner']},
+            ]))
+
+        # The servers of both of the joins are materialized together, and
+        # the outer ones are not fetched again for the inner joins.
+        self.assertEqual(len([
+            c for c in queries.captured_queries
+            if c['sql'].startswith('WITH matched')
+        ]), 4)
+        self.assertNotIn('hypervisor', servers[0])
+        for server in servers:
+            self.assertEqual(server['project']['owner'], 'alice')
+            self.assertNotIn('hostname', server['project'])
+        for server in servers[1:]:
+            hypervisor = server['hypervisor']
+            self.assertEqual(hypervisor['hostname'], 'test0')
+            self.assertEqual(hypervisor['os'], 'wheezy')
+            self.assertEqual(hypervisor['project']['hostname'], 'p1')
+            self.assertEqual(hypervisor['project']['owner'], 'alice')
+
+    def _test_related_owners(self):
+        hostnames = ['p1', 'test0', 'test1', 'test2', 'test3']
+        owners = {
+            s['hostname']: s['owner']
+            for s in Query({'owner': 'alice'}, ['hostname', 'owner'])
+        }
+        self.assertEqual(owners, {h: 'alice' for h in hostnames})
+        owners = {
+            s['hostname']: s['owner']
+            for s in Query({'owner': Not('bob')}, ['hostname', 'owner'])
+        }
+        self.assertEqual(owners, {h: 'alice' for h in hostnames})
+        self.assertEqual(len(Query({'owner': Any('bob', Empty())})), 0)
+        projects = {
+            s['hostname']: s['project']
+            for s in Query({'project': 'p1'}, ['hostname', 'project'])
+        }
+        self.assertEqual(projects, {h: 'p1' for h in hostnames[1:]})
+
 
 class TestCommit(TransactionTestCase):
     fixtures = ['test_dataset.json']
@@ -92,6 +521,266 @@ class TestCommit(TransactionTestCase):
         self.assertEqual(s['os'], 'wheezy')
         self.assertEqual(s['intern_ip'], IPv4Address('10.16.2.1'))
 
+    def test_commit_changed_attributes(self):
+        s = Query({'hostname': 'test1'}, ['object_id']).get()
+        commit = commit_query(changed=[{
+            'object_id': s['object_id'],
+            'os': {'action': 'update', 'old': 'squeeze', 'new': 'wheezy'},
+        }], user=User.objects.first())
+
+        # The changed objects are returned only with the attributes the
+        # commit has looked at, as documented on commit_query().
+        changed = commit.changed[0]
+        self.assertEqual(changed['os'], 'wheezy')
+        self.assertNotIn('game_world', changed)
+
+    def test_commit_multi(self):
+        q = Query({'hostname': 'test0'}, ['database'])
+        q.get()['database'].update({'db0', 'db1'})
+        q.commit(user=User.objects.first())
+
+        q = Query({'hostname': 'test0'}, ['database'])
+        s = q.get()
+        self.assertEqual(s['database'], {'db0', 'db1'})
+        s['database'].remove('db0')
+        s['database'].add('db2')
+        q.commit(user=User.objects.first())
+
+        s = Query({'hostname': 'test0'}, ['database']).get()
+        self.assertEqual(s['database'], {'db1', 'db2'})
+
+        # The values which are already there cannot be added again.
+        with self.assertRaises(ValidationError):
+            commit_query(changed=[{
+                'object_id': s['object_id'],
+                'database': {'action': 'multi', 'add': ['db1'], 'remove': []},
+            }], user=User.objects.first())
+
+    def test_commit_create(self):
+        commit_query(created=[
+            {
+                'hostname': 'test{}'.format(i),
+                'servertype': 'test0',
+                'intern_ip': '10.16.1.{}'.format(i),
+                'database': ['db{}'.format(i)],
+            }
+            for i in (4, 5)
+        ], user=User.objects.first())
+
+        databases = {
+            s['hostname']: s['database']
+            for s in Query({'servertype': 'test0'}, ['hostname', 'database'])
+        }
+        self.assertEqual(databases['test4'], {'db4'})
+        self.assertEqual(databases['test5'], {'db5'})
+
+        # The new servers are checked against each other, too.
+        with self.assertRaises(ValidationError):
+            commit_query(created=[
+                {
+                    'hostname': hostname,
+                    'servertype': 'test0',
+                    'intern_ip': '10.16.1.6',
+                }
+                for hostname in ('test6', 'test7')
+            ], user=User.objects.first())
+
+    def _create_hypervisor_attribute(self):
+        Attribute.objects.create(
+            attribute_id='hypervisor',
+            type='relation',
+            target_servertype_id='test0',
+            regexp=r'\A.*\Z',
+        )
+        ServertypeAttribute.objects.create(
+            servertype_id='test2', attribute_id='hypervisor'
+        )
+
+    def test_commit_create_related(self):
+        self._create_hypervisor_attribute()
+
+        # The target of the relation is created by the same commit.
+        commit_query(created=[
+            {
+                'hostname': 'test5',
+                'servertype': 'test2',
+                'intern_ip': '10.16.1.5',
+                'os': 'wheezy',
+                'hypervisor': 'test4',
+            },
+            {
+                'hostname': 'test4',
+                'servertype': 'test0',
+                'intern_ip': '10.16.1.4',
+            },
+        ], user=User.objects.first())
+
+        s = Query({'hostname': 'test5'}, ['hypervisor']).get()
+        self.assertEqual(s['hypervisor'], 'test4')
+
+    def test_commit_change_related(self):
+        self._create_hypervisor_attribute()
+        s = Query({'hostname': 'test1'}, ['object_id']).get()
+
+        # The target of the relation is created by the same commit.
+        commit_query(
+            created=[{
+                'hostname': 'test4',
+                'servertype': 'test0',
+                'intern_ip': '10.16.1.4',
+            }],
+            changed=[{
+                'object_id': s['object_id'],
+                'hypervisor': {
+                    'action': 'update', 'old': None, 'new': 'test4'
+                },
+            }],
+            user=User.objects.first(),
+        )
+
+        s = Query({'hostname': 'test1'}, ['hypervisor']).get()
+        self.assertEqual(s['hypervisor'], 'test4')
+
+    def test_commit_access_control(self):
+        user = User.objects.create(username='test')
+        acl = AccessControlGroup.objects.create(
+            name='test', query='servertype=test2'
+        )
+        acl.attributes.add(Attribute.objects.get(pk='os'))
+
+        q = Query({'hostname': 'test1'}, ['os', 'game_world'])
+        q.get()['os'] = 'wheezy'
+        with self.assertRaises(PermissionDenied):
+            q.commit(user=user)
+
+        # The cached ACLs must see the new member.
+        acl.members.add(user)
+        q.commit(user=user)
+
+        q.get()['game_world'] = 5
+        with self.assertRaises(PermissionDenied):
+            q.commit(user=user)
+
+    def test_commit_access_control_derived(self):
+        Attribute.objects.create(
+            attribute_id='domain',
+            type='domain',
+            target_servertype_id='test0',
+            readonly=True,
+            regexp=r'\A.*\Z',
+        )
+        ServertypeAttribute.objects.create(
+            servertype_id='test2', attribute_id='domain'
+        )
+        ServertypeAttribute.objects.create(
+            servertype_id='test2',
+            attribute_id='database',
+            related_via_attribute_id='domain',
+        )
+        q = Query({'hostname': 'test0'}, ['database'])
+        q.get()['database'].add('db0')
+        q.commit(user=User.objects.first())
+
+        user = User.objects.create(username='test')
+        acl = AccessControlGroup.objects.create(
+            name='test', query='servertype=test2', is_whitelist=False
+        )
+        acl.attributes.add(Attribute.objects.get(pk='database'))
+        acl.members.add(user)
+
+        q = Query({'hostname': 'test1'}, ['os'])
+        q.get()['os'] = 'wheezy'
+        q.commit(user=user)
+
+        # The database changes with the domain, and that with the hostname.
+        q = Query({'hostname': 'test1'}, ['hostname'])
+        q.get()['hostname'] = 'test1.test0'
+        with self.assertRaises(PermissionDenied):
+            q.commit(user=user)
+        q.commit(user=User.objects.first())
+        s = Query({'hostname': 'test1.test0'}, ['domain', 'database']).get()
+        self.assertEqual(s['domain'], 'test0')
+        self.assertEqual(s['database'], {'db0'})
+
+    def test_commit_number(self):
+        q = Query({'hostname': 'test2'}, ['game_world'])
+        q.get()['game_world'] = 3
+        q.commit(user=User.objects.first())
+        ServerNumberAttribute.objects.filter(
+            server__hostname='test1', attribute_id='game_world'
+        ).update(value=2.5)
+
+        values = {
+            s['hostname']: s['game_world']
+            for s in Query(
+                {'game_world': GreaterThan(2)}, ['hostname', 'game_world']
+            )
+        }
+        self.assertEqual(values, {'test1': 2.5, 'test2': 3, 'test3': 10})
+        self.assertIsInstance(values['test2'], int)
+
+        # The integers which cannot be stored exactly are refused.
+        q = Query({'hostname': 'test2'}, ['game_world'])
+        q.get()['game_world'] = 2 ** 53
+        q.commit(user=User.objects.first())
+        q.get()['game_world'] = 2 ** 60 + 1
+        with self.assertRaises(ValidationError):
+            q.commit(user=User.objects.first())
+        s = Query({'hostname': 'test2'}, ['game_world']).get()
+        self.assertEqual(s['game_world'], 2 ** 53)
+
+    def test_commit_cached_query(self):
+        q = Query({'hostname': 'test1'}, ['os'])
+        q.get()['os'] = 'wheezy'
+
+        # The change is not committed yet, the cache must not see it.
+        s = Query({'hostname': 'test1'}, ['os']).get()
+        self.assertEqual(s['os'], 'squeeze')
+
+        q.commit(user=User.objects.first())
+        s = Query({'hostname': 'test1'}, ['os']).get()
+        self.assertEqual(s['os'], 'wheezy')
+
+    def test_saved_attribute_cached_query(self):
+        s = Query({'hostname': 'test1'}, ['game_world']).get()
+        self.assertEqual(s['game_world'], 1)
+
+        # Like the Graphite integration saves the attributes
+        ServerNumberAttribute.objects.update_or_create(
+            server__hostname='test1',
+            attribute_id='game_world',
+            defaults={'value': 42},
+        )
+        s = Query({'hostname': 'test1'}, ['game_world']).get()
+        self.assertEqual(s['game_world'], 42)
+
+    def test_commit_query_etag(self):
+        etag = get_query_etag({'hostname': Any('test1')}, ['os'], None)
+        self.assertEqual(
+            etag, get_query_etag({'hostname': Any('test1')}, ['os'], None)
+        )
+        self.assertNotEqual(
+            etag, get_query_etag({'hostname': Any('test1')}, ['os'], None, 1)
+        )
+
+        q = Query({'hostname': 'test1'}, ['os'])
+        q.get()['os'] = 'wheezy'
+        q.commit(user=User.objects.first())
+        self.assertNotEqual(
+            etag, get_query_etag({'hostname': Any('test1')}, ['os'], None)
+        )
+
+    def test_saved_attribute_query_etag(self):
+        etag = get_query_etag({'hostname': 'test1'}, ['game_world'], None)
+        ServerNumberAttribute.objects.update_or_create(
+            server__hostname='test1',
+            attribute_id='game_world',
+            defaults={'value': 42},
+        )
+        self.assertNotEqual(
+            etag, get_query_etag({'hostname': 'test1'}, ['game_world'], None)
+        )
+
     def test_commit_regexp_violation(self):
         pass
 
@@ -0,0 +1,100 @@
+"""Serveradmin
+
+Copyright (c) 2019 InnoGames GmbH
+"""
+
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from serveradmin.dataset import Query
+from serveradmin.serverdb import routers
+from serveradmin.serverdb.models import Server, invalidate_data
+from serveradmin.serverdb.query_cache import get_data_version
+from serveradmin.serverdb.routers import (
+    choose_read_alias,
+    get_read_alias,
+    read_replica,
+    remember_data_version,
+)
+
+REPLICA_ALIAS = 'test_replica'
+
+
+@override_settings(REPLICA_DATABASES=[REPLICA_ALIAS])
+class TestReadReplica(TransactionTestCase):
+    fixtures = ['test_dataset.json']
+
+    def setUp(self):
+        # The replica is another connection to the test database.  It sees
+        # the committed changes immediately, so the lag is simulated by
+        # remembering a newer version than the one on the database.
+        connections.databases[REPLICA_ALIAS] = dict(
+            connections.databases[DEFAULT_DB_ALIAS]
+        )
+        self._written_data_version = routers._written_data_version
+
+    def tearDown(self):
+        routers._written_data_version = self._written_data_version
+        connections[REPLICA_ALIAS].close()
+        del connections[REPLICA_ALIAS]
+        del connections.databases[REPLICA_ALIAS]
+
+    def test_read_replica(self):
+        self.assertEqual(get_read_alias(), DEFAULT_DB_ALIAS)
+        with read_replica() as alias:
+            self.assertEqual(alias, REPLICA_ALIAS)
+            self.assertEqual(get_read_alias(), REPLICA_ALIAS)
+            self.assertEqual(Server.objects.all().db, REPLICA_ALIAS)
+
+            # The inner blocks keep using the same database.
+            with read_replica() as inner_alias:
+                self.assertEqual(inner_alias, REPLICA_ALIAS)
+
+        self.assertEqual(get_read_alias(), DEFAULT_DB_ALIAS)
+
+    def test_read_replica_atomic(self):
+        with transaction.atomic():
+            with read_replica() as alias:
+                self.assertEqual(alias, DEFAULT_DB_ALIAS)
+                self.assertEqual(Server.objects.all().db, DEFAULT_DB_ALIAS)
+
+    def test_query_replica(self):
+        with CaptureQueriesContext(connections[REPLICA_ALIAS]) as queries:
+            s = Query({'hostname': 'test1'}, ['os']).get()
+        self.assertEqual(s['os'], 'squeeze')
+        self.assertTrue(queries.captured_queries)
+
+    @override_settings(REPLICA_READ_YOUR_WRITES=True)
+    def test_read_your_writes(self):
+        q = Query({'hostname': 'test1'}, ['os'])
+        q.get()['os'] = 'wheezy'
+        q.commit(user=User.objects.first())
+
+        # The replica has the version written by the commit.
+        self.assertEqual(routers._written_data_version, get_data_version())
+        self.assertEqual(choose_read_alias(), REPLICA_ALIAS)
+
+        remember_data_version(get_data_version() + 1)
+        self.assertEqual(choose_read_alias(), DEFAULT_DB_ALIAS)
+
+    def test_data_version(self):
+        version = get_data_version()
+
+        with transaction.atomic():
+            invalidate_data()
+
+            # The replicas see the new version only together with
+            # the changes of the transaction.
+            self.assertEqual(get_data_version(), version + 1)
+            with connections[REPLICA_ALIAS].cursor() as cursor:
+                cursor.execute('SELECT version FROM data_version')
+                self.assertEqual(cursor.fetchone()[0], version)
+
+            # The version is remembered only after the commit.
+            self.assertLess(routers._written_data_version, version + 1)
+
+        self.assertEqual(routers._written_data_version, version + 1)
+        with read_replica():
+            self.assertEqual(get_data_version(), version + 1)